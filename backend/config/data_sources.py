@@ -17,6 +17,14 @@ company_details_url = 'https://www.macrotrends.net/stocks/charts/{}/filler/share
 yahoo_finance_url = 'https://query1.finance.yahoo.com/v7/finance/download' \
                     '/{}?period1={}&period2={}&interval=1d&events=history'
 
+# Seconds responses of a data source host are kept in the on-disk HTTP cache when it's enabled
+cache_ttl = {
+    'home.treasury.gov': 60 * 60 * 6,
+    'query1.finance.yahoo.com': 60 * 60 * 6,
+    'www.slickcharts.com': 60 * 60 * 12,
+    'www.macrotrends.net': 60 * 60 * 24 * 7,  # Share counts change quarterly
+}
+
 # Yahoo code(ticker) of a company/asset might differ from general one.
 # So we keep dictionary for transforming in format {local_code: yahoo_code}
 local_codes_to_yahoo = {
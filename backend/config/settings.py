@@ -20,7 +20,9 @@ ROOT_DIR = BASE_DIR.parent
 LOGS_DIR = ROOT_DIR / 'logs'
 LOGS_DIR.mkdir(parents=True, exist_ok=True)
 
-env = Env(DEBUG=(bool, True), DJANGO_LOG_LEVEL=(str, 'INFO'))
+env = Env(DEBUG=(bool, True), DJANGO_LOG_LEVEL=(str, 'INFO'), SYNC_WORKERS=(int, 8), SYNC_RATE_LIMIT=(float, 5.0),
+          SYNC_PARALLEL=(int, 1), HTTP_CACHE_DIR=(str, ''), PRICE_STORE_DIR=(str, ''),
+          REPORTS_CACHE_TIMEOUT=(int, 60 * 60 * 24))
 Env.read_env(ROOT_DIR / '.env')
 
 # Quick-start development settings - unsuitable for production
@@ -94,6 +96,17 @@ DATABASES = {
     }
 }
 
+# Cache
+# Local memory by default, set CACHE_URL to switch backend, e.g. filecache:///var/tmp/canary or rediscache://host:6379
+# Syncs invalidate reports through the database, but a local memory cache is per process: each server worker keeps
+# its own copy of reports and hit/miss stats are not visible to syncs, use a shared backend for several workers
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+# Reports are invalidated by syncs, timeout only limits the lifetime of reports for stale parameters
+REPORTS_CACHE_TIMEOUT = env('REPORTS_CACHE_TIMEOUT')
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -158,6 +171,18 @@ LOGGING = {
     },
 }
 
+# Data sync
+# Number of concurrent downloads and max requests per second to a single data source host
+
+SYNC_WORKERS = env('SYNC_WORKERS')
+SYNC_RATE_LIMIT = env('SYNC_RATE_LIMIT')
+# Number of independent sync stages run at once
+SYNC_PARALLEL = env('SYNC_PARALLEL')
+# Directory to cache data sources responses in, disabled if empty
+HTTP_CACHE_DIR = env('HTTP_CACHE_DIR')
+# Directory of the memory-mapped stock prices store shared by server workers, disabled if empty
+PRICE_STORE_DIR = env('PRICE_STORE_DIR')
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.1/topics/i18n/
 
@@ -0,0 +1,116 @@
+import hashlib
+from datetime import datetime, time, timezone
+from typing import Iterator, Optional
+
+import orjson
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.http.request import HttpRequest
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.http import condition
+
+from .cache import cached_report, get_data_version, get_generation
+from .helpers import parse_date, parse_int
+from .models import TreasuryRates, YahooStockPrice, YahooAssetPrice, SyncRun
+from .reports import DOWNSAMPLE_MODES, downsample_rates, get_rates_per_day, get_sectors_report
+
+JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+class JSONResponse(HttpResponse):
+    """Response with data serialized by orjson"""
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=orjson.dumps(data, option=JSON_OPTIONS), **kwargs)
+
+
+def _as_datetime(day) -> Optional[datetime]:
+    return datetime.combine(day, time.min, tzinfo=timezone.utc) if day else None
+
+
+def _last_modified(day) -> Optional[datetime]:
+    """Get the latest of a data date and of the latest sync finish, syncs also change rows of older dates"""
+    finished = SyncRun.objects.order_by('-pk').values_list('finished', flat=True).first()
+    return max(filter(None, [_as_datetime(day), finished]), default=None)
+
+
+def _etag(version: str, request: HttpRequest) -> str:
+    """Build ETag from data version and request parameters"""
+    return hashlib.md5(f'{version}?{request.GET.urlencode()}'.encode()).hexdigest()
+
+
+def rates_last_modified(request: HttpRequest, *args, **kwargs) -> Optional[datetime]:
+    return _last_modified(TreasuryRates.objects.values_list('date', flat=True).first())
+
+
+def rates_etag(request: HttpRequest, *args, **kwargs) -> str:
+    return _etag(f'{TreasuryRates.objects.values_list("date", flat=True).first()}:{get_generation()}', request)
+
+
+def prices_last_modified(request: HttpRequest, *args, **kwargs) -> Optional[datetime]:
+    dates = [model.objects.values_list('date', flat=True).first() for model in [YahooStockPrice, YahooAssetPrice]]
+    return _last_modified(max(filter(None, dates), default=None))
+
+
+def prices_etag(request: HttpRequest, *args, **kwargs) -> str:
+    return _etag(get_data_version(), request)
+
+
+@method_decorator(condition(etag_func=rates_etag, last_modified_func=rates_last_modified), name='get')
+class RatesAPIView(View):
+    """Treasury par yield rates per date, streamed for the whole period unless a limit is given"""
+    chunk_size = 2000
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        limit = request.GET.get('limit')
+        if limit and not (limit.isdigit() and int(limit) > 0):
+            return HttpResponseBadRequest('Limit must be a positive integer')
+        mode = request.GET.get('mode') or 'lttb'
+        if mode not in DOWNSAMPLE_MODES:
+            return HttpResponseBadRequest(f'Mode must be one of: {", ".join(DOWNSAMPLE_MODES)}')
+        fields = TreasuryRates.get_fields_list()
+        query = TreasuryRates.objects.order_by('date')
+        since, to = parse_date(request.GET.get('since')), parse_date(request.GET.get('to'))
+        if since:
+            query = query.filter(date__gte=since)
+        if to:
+            query = query.filter(date__lte=to)
+
+        # Rows are fetched here, the ASGI handler consumes streamed content in the event loop with no ORM access
+        rates = list(query.values(*fields))
+        if limit:
+            return JSONResponse(downsample_rates(rates, int(limit), mode))
+        return StreamingHttpResponse(self.stream(rates), content_type='application/json')
+
+    def stream(self, rates: list[dict]) -> Iterator[bytes]:
+        """Serialize rates as a JSON array chunk by chunk, the whole body is never held in memory"""
+        yield b'['
+        for start in range(0, len(rates), self.chunk_size):
+            chunk = orjson.dumps(rates[start:start + self.chunk_size], option=JSON_OPTIONS)[1:-1]  # No brackets
+            yield b',' + chunk if start else chunk
+        yield b']'
+
+
+@method_decorator(condition(etag_func=rates_etag, last_modified_func=rates_last_modified), name='get')
+class RatesPerDayAPIView(View):
+    """Yield curves for custom dates and the last day, week, month and so on ago"""
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        return JSONResponse(get_rates_per_day([parse_date(day) for day in request.GET.getlist('when')]))
+
+
+@method_decorator(condition(etag_func=prices_etag, last_modified_func=prices_last_modified), name='get')
+class DynamicsAPIView(View):
+    """Assets or market sectors dynamics for default periods and a custom range"""
+    report = None  # Key of sectors report part: assets or sectors
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        custom_since = parse_date(request.GET.get('since'))
+        custom_to = parse_date(request.GET.get('to')) if custom_since else None
+        top = parse_int(request.GET.get('top'), 3, 1, 20)
+        reports, _ = cached_report('sectors', {'since': custom_since, 'to': custom_to, 'top': top},
+                                   lambda: get_sectors_report(custom_since, custom_to, top))
+        if self.report == 'assets':
+            return JSONResponse({'S&P 500': reports['sp500'], **reports['assets']})
+        return JSONResponse(reports[self.report])
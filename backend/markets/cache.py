@@ -0,0 +1,88 @@
+from datetime import date
+from typing import Any, Awaitable, Callable
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from markets.models import YahooStockPrice, YahooAssetPrice, SyncRun
+
+HITS_KEY = 'reports:hits'
+MISSES_KEY = 'reports:misses'
+
+
+def _incr(key: str) -> None:
+    # Sync incr is atomic for cache backends, default async one is a get followed by a set
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:  # Evicted in between
+        cache.add(key, 1, timeout=None)
+
+
+def is_shared_cache() -> bool:
+    """Check whether the cache is shared by processes, the local memory one is per process"""
+    return not isinstance(caches['default'], LocMemCache)  # `cache` is a proxy of it
+
+
+def get_generation() -> int:
+    """Get id of the latest completed sync, kept in the database so syncs in other processes invalidate reports"""
+    return SyncRun.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def get_data_version() -> str:
+    """Get version of market data reports are built from: today, latest price dates and sync generation"""
+    stock_date = YahooStockPrice.objects.values_list('date', flat=True).first()
+    asset_date = YahooAssetPrice.objects.values_list('date', flat=True).first()
+    return f'{date.today()}:{stock_date}:{asset_date}:{get_generation()}'  # Custom ranges are relative to today
+
+
+async def aget_data_version() -> str:
+    """Async version of `get_data_version`"""
+    stock_date = await YahooStockPrice.objects.values_list('date', flat=True).afirst()
+    asset_date = await YahooAssetPrice.objects.values_list('date', flat=True).afirst()
+    generation = await SyncRun.objects.order_by('-pk').values_list('pk', flat=True).afirst() or 0
+    return f'{date.today()}:{stock_date}:{asset_date}:{generation}'
+
+
+def invalidate_reports(sync_type: str = '') -> None:
+    """Make all cached reports stale, called when a sync completes"""
+    SyncRun.objects.create(type=sync_type)
+
+
+def get_cache_stats() -> dict[str, int]:
+    """Get numbers of cached reports hits and misses"""
+    return {'hits': cache.get(HITS_KEY, 0), 'misses': cache.get(MISSES_KEY, 0)}
+
+
+def _normalize(params: dict[str, Any]) -> str:
+    return '&'.join(f'{key}={value.isoformat() if isinstance(value, date) else value or ""}'
+                    for key, value in sorted(params.items()))
+
+
+def cached_report(name: str, params: dict[str, Any], build: Callable[[], Any]) -> tuple[Any, bool]:
+    """Get a report from cache or build and cache it, return the report and whether it was a cache hit"""
+    key = f'reports:{name}:{get_data_version()}:{_normalize(params)}'
+    res = cache.get(key)
+    if res is not None:
+        _incr(HITS_KEY)
+        return res, True
+    _incr(MISSES_KEY)
+    res = build()
+    cache.set(key, res, timeout=settings.REPORTS_CACHE_TIMEOUT)
+    return res, False
+
+
+async def acached_report(name: str, params: dict[str, Any],
+                         build: Callable[[], Awaitable]) -> tuple[Any, bool]:
+    """Async version of `cached_report` for a coroutine building the report"""
+    key = f'reports:{name}:{await aget_data_version()}:{_normalize(params)}'
+    res = await cache.aget(key)
+    if res is not None:
+        await sync_to_async(_incr)(HITS_KEY)
+        return res, True
+    await sync_to_async(_incr)(MISSES_KEY)
+    res = await build()
+    await cache.aset(key, res, timeout=settings.REPORTS_CACHE_TIMEOUT)
+    return res, False
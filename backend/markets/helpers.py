@@ -1,5 +1,7 @@
 import re
-from datetime import datetime
+from datetime import date, datetime, timedelta
+
+import numpy as np
 
 
 def parse_date(date_str: str):
@@ -29,8 +31,74 @@ def parse_date(date_str: str):
         pass
 
 
+def parse_int(value: str, default: int, minimum: int, maximum: int) -> int:
+    """Parse an integer request parameter clamped to a range, the default for a missing or malformed one"""
+    try:
+        return min(max(int(value), minimum), maximum)
+    except (TypeError, ValueError):
+        return default
+
+
 def separate_capitalize(period_str: str):
     match = re.search(r'\d', period_str)
     if not match:
         return ''
-    return ' '.join((period_str[:match.start()].title(), period_str[match.start():]))
\ No newline at end of file
+    return ' '.join((period_str[:match.start()].title(), period_str[match.start():]))
+
+
+def downsample_uniform(x: np.ndarray, limit: int) -> np.ndarray:
+    """Get indexes of points nearest to `limit` evenly spaced values of sorted x, first and last included"""
+    if len(x) <= limit:
+        return np.arange(len(x))
+    targets = np.linspace(x[0], x[-1], limit)
+    right = np.clip(np.searchsorted(x, targets), 1, len(x) - 1)
+    nearest = np.where(targets - x[right - 1] <= x[right] - targets, right - 1, right)
+    return np.unique(nearest)
+
+
+def downsample_lttb(x: np.ndarray, y: np.ndarray, limit: int) -> np.ndarray:
+    """Get indexes of `limit` points preserving the shape of a series with Largest-Triangle-Three-Buckets"""
+    if len(x) <= limit:
+        return np.arange(len(x))
+    if limit < 3:  # No room for buckets between the first and the last points
+        return downsample_uniform(x, limit)
+    # First and last points are always kept, the rest are split into equal buckets
+    edges = np.linspace(1, len(x) - 1, limit - 1).astype(int)
+    indexes = np.empty(limit, dtype=int)
+    indexes[0], indexes[-1] = 0, len(x) - 1
+    for bucket in range(limit - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else len(x)
+        # Third point of the triangle is the average of the next bucket
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        prev_x, prev_y = x[indexes[bucket]], y[indexes[bucket]]
+        areas = np.abs((prev_x - next_x) * (y[start:end] - prev_y) - (prev_x - x[start:end]) * (next_y - prev_y))
+        indexes[bucket + 1] = start + np.argmax(areas)
+    return indexes
+
+
+def merge_ranges(ranges: list[tuple[date, date]]) -> list[tuple[date, date]]:
+    """Merge overlapping or adjacent inclusive date ranges into sorted disjoint ones"""
+    merged = []
+    for since, to in sorted(ranges):
+        if merged and since <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], to))
+        else:
+            merged.append((since, to))
+    return merged
+
+
+def subtract_ranges(ranges: list[tuple[date, date]], holes: list[tuple[date, date]]) -> list[tuple[date, date]]:
+    """Remove inclusive date ranges of holes from ranges, return sorted disjoint remainders"""
+    res = []
+    holes = merge_ranges(holes)
+    for since, to in merge_ranges(ranges):
+        for hole_since, hole_to in holes:
+            if hole_to < since or hole_since > to:
+                continue
+            if hole_since > since:
+                res.append((since, hole_since - timedelta(days=1)))
+            since = hole_to + timedelta(days=1)
+        if since <= to:
+            res.append((since, to))
+    return res
@@ -0,0 +1,423 @@
+import asyncio
+import logging
+import tempfile
+from datetime import date, datetime, timedelta
+from io import StringIO
+from itertools import chain
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+from django.core.management import CommandError
+from django.db import connection
+from django.test import AsyncClient, override_settings
+
+from markets.management.parsers import PRICES_DTYPES, clean_prices, parse_prices, parse_shares, parse_top500
+from markets.models import Company, CompanyQuerySet, TreasuryRates
+from markets.reports import RATES_PER_DAY_OFFSETS, SECTOR_VALUE_FIELDS, compute_price_changes, compute_sector_changes, \
+    downsample_rates, get_price_changes_per_company, get_rates_per_day, get_sector_outstanding, get_shares_per_company
+from markets.store import get_price_store, write_price_store
+
+logger = logging.getLogger('django')
+
+
+def measure(func: Callable, repeat: int = 5) -> float:
+    """Run a function several times and return the best wall time in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        timings.append(perf_counter() - start)
+    return min(timings) * 1000
+
+
+def synthetic_prices(items: int = 500, days: int = 400, seed: int = 0) -> pd.DataFrame:
+    """Build a random walk close prices frame ordered the same way as price models are (-date, item)"""
+    rng = np.random.default_rng(seed)
+    today = date.today()
+    dates = [today - timedelta(days=day) for day in range(days)]
+    closes = 100 * np.cumprod(1 + rng.normal(0, 0.01, size=(days, items)), axis=0)
+    return pd.DataFrame({
+        'date': np.repeat(dates, items),
+        'company': np.tile(np.arange(1, items + 1), days),
+        'close': closes.ravel().round(4),
+    })
+
+
+def synthetic_rates(since: date = date(1990, 1, 1), seed: int = 0) -> list[dict]:
+    """Build random walk yields for every business day since a date, as rows of TreasuryRates values"""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(since, date.today()).date
+    fields = [field for field in TreasuryRates.get_fields_list() if field != 'date']
+    yields = np.abs(3 + np.cumsum(rng.normal(0, 0.03, size=(len(dates), len(fields))), axis=0)).round(2)
+    return [{'date': day, **dict(zip(fields, row))} for day, row in zip(dates, yields.tolist())]
+
+
+def legacy_price_changes(df: pd.DataFrame, companies: list[tuple], custom_offset_since: int = 0,
+                         custom_offset_to: int = 0) -> dict:
+    """Per-company loop the sectors report used before the matrix engine, kept as a reference"""
+    res = dict()
+    for pk, code, sector in companies:
+        company_res = {'code': code, 'sector': sector}
+        company_df = df.loc[df['company'] == pk]
+        if company_df.empty:
+            continue
+        cur_price = company_df['close'].iloc[0]
+        company_res['current_price'] = cur_price
+        for period_name, period in CompanyQuerySet.changes.items():
+            if period >= len(company_df.index):
+                continue
+            company_res[period_name] = round(cur_price / company_df['close'].iloc[period], 4)
+        if custom_offset_since and custom_offset_since < len(company_df.index):
+            custom_price = cur_price
+            if custom_offset_to and custom_offset_to < len(company_df.index):
+                custom_price = company_df['close'].iloc[custom_offset_to]
+                company_res['custom_price'] = custom_price
+            company_res['change_custom'] = round(custom_price / company_df['close'].iloc[custom_offset_since], 4)
+        res[pk] = company_res
+    return res
+
+
+def legacy_parse_top500(page: str) -> list[str]:
+    """BeautifulSoup parsing of the top500 page used before the lxml parser, kept as a reference"""
+    tbody = BeautifulSoup(page, 'lxml').select_one('div.col-lg-7 tbody')
+    return [row.find_all('td')[2].next.text.upper() for row in tbody.find_all('tr')]
+
+
+def legacy_parse_shares(page: str) -> list[tuple[str, str]]:
+    """BeautifulSoup parsing of a shares outstanding page used before the lxml parser, kept as a reference"""
+    tbody = BeautifulSoup(page, 'lxml').find_all('tbody')
+    return [tuple(col.text for col in row.find_all('td')[:2]) for row in tbody[1].find_all('tr')]
+
+
+def synthetic_top500_page(companies: int = 503, seed: int = 0) -> str:
+    """Build a page with the markup of the slickcharts S&P 500 table, the third symbol is a lowercase class share"""
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    symbols = [''.join(rng.choice(letters, size=rng.integers(1, 5))) for _ in range(companies)]
+    symbols[2] = 'brk.b'
+    rows = ''.join(f'<tr>\n<td>{index}</td>\n<td><a href="/symbol/{symbol}">Company {index} Inc.</a></td>\n'
+                   f'<td><a href="/symbol/{symbol}">{symbol}</a></td>\n<td>{weight:.6f}</td>\n'
+                   f'<td>&nbsp;&nbsp;{price:.2f}</td>\n<td style="color: green">{change:.2f}</td>\n'
+                   f'<td style="color: green">({change / price:.2%})</td>\n</tr>\n'
+                   for index, (symbol, weight, price, change) in enumerate(
+                       zip(symbols, rng.uniform(0, 7, companies), rng.uniform(10, 500, companies),
+                           rng.normal(0, 2, companies)), start=1))
+    return ('<!DOCTYPE html>\n<html lang="en">\n<head><title>S&amp;P 500 Companies by Weight</title></head>\n<body>\n'
+            '<div class="container-fluid"><div class="row">\n<div class="col-lg-7"><div class="table-responsive">'
+            '<table class="table table-hover table-borderless table-sm">\n<thead><tr><th>#</th><th>Company</th>'
+            '<th>Symbol</th><th>Weight</th><th>Price</th><th>Chg</th><th>% Chg</th></tr></thead>\n'
+            f'<tbody>\n{rows}</tbody></table></div></div>\n</div></div>\n</body>\n</html>\n')
+
+
+def synthetic_shares_page(quarters: int = 56, seed: int = 0) -> str:
+    """Build a page with the markup of macrotrends annual and quarterly shares outstanding tables, a count is missing"""
+    rng = np.random.default_rng(seed)
+    years = [str(year) for year in range(2022, 2022 - quarters // 4, -1)]
+    days = pd.date_range(end=date(2022, 12, 31), periods=quarters, freq='4M')[::-1].strftime('%Y-%m-%d')
+    annual = [f'{count:,}' for count in rng.integers(15000, 17000, len(years))]
+    quarterly = [f'{count:,}' for count in rng.integers(15000, 17000, quarters)]
+    quarterly[10] = ''
+    tables = []
+    for rows in [zip(years, annual), zip(days, quarterly)]:
+        cells = ''.join(f'<tr><td style="text-align:center">{day}</td><td style="text-align:center">{count}</td></tr>\n'
+                        for day, count in rows)
+        tables.append('<div class="col-xs-6"><table class="historical_data_table table"><thead><tr><th colspan="2">'
+                      f'Shares Outstanding</th></tr></thead><tbody>\n{cells}</tbody></table></div>\n')
+    return ('<!DOCTYPE html>\n<html lang="en">\n<head><title>Shares Outstanding</title></head>\n<body>\n'
+            f'{"".join(tables)}</body>\n</html>\n')
+
+
+def synthetic_prices_csv(days: int = 365 * 25, seed: int = 0) -> str:
+    """Build a Yahoo Finance like CSV with business day prices for a period in days"""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(end=date.today(), periods=days * 5 // 7)
+    closes = 100 * np.cumprod(1 + rng.normal(0, 0.01, size=len(dates)))
+    frame = pd.DataFrame({'Date': dates.strftime('%Y-%m-%d'), 'Open': closes * 0.99, 'High': closes * 1.01,
+                          'Low': closes * 0.98, 'Close': closes, 'Adj Close': closes,
+                          'Volume': rng.integers(10 ** 5, 10 ** 7, size=len(dates))})
+    return frame.to_csv(index=False, float_format='%.6f')
+
+
+def legacy_clean_prices(prices: pd.DataFrame) -> pd.DataFrame:
+    """Element-wise prices cleaning used before the vectorized one, kept as a reference"""
+    prices = prices.copy()
+    prices.index = pd.DatetimeIndex(prices['Date'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d')))
+    prices = prices[~prices.index.duplicated(keep='first')]
+    prices.drop('Date', axis=1, inplace=True)
+    prices.columns = list(map(str.lower, prices.columns))
+    prices = prices.resample('D').interpolate(limit=30)
+    prices = prices.apply(lambda series: series.apply(int) if series.name == 'volume'
+                          else series.apply(lambda x: round(float(x), 4)))
+    prices.dropna(inplace=True)
+    return prices
+
+
+def synthetic_sectors_perf(companies: int = 500, sectors: int = 11, seed: int = 0) -> tuple[dict, dict]:
+    """Build sectors and companies performance as `get_market_dynamics` does, with custom range changes"""
+    rng = np.random.default_rng(seed)
+    fields = [*CompanyQuerySet.changes, 'change_custom']
+    companies_perf = {}
+    for pk in range(1, companies + 1):
+        changes = rng.normal(1, 0.1, size=len(fields)).round(6)
+        perf = {'code': f'C{pk}', 'sector': f'sector{pk % sectors}', **dict(zip(fields, changes.tolist()))}
+        perf[fields[pk % len(fields)]] = None  # Companies listed recently have no price for some dates
+        current_price, custom_price = rng.uniform(10, 500, size=2).round(4).tolist()
+        shares = int(rng.integers(10 ** 7, 10 ** 10)) if pk % 50 else None  # Some share counts are missing
+        perf.update(current_price=current_price, custom_price=custom_price, shares=shares)
+        companies_perf[pk] = perf
+    sectors_perf = {f'sector{i}': {'sector_change_custom': 0} for i in range(sectors)}
+    return sectors_perf, companies_perf
+
+
+def legacy_sector_outstanding(sectors_perf: dict, companies_perf: dict, top: int = 3) -> None:
+    """Per-sector sorting used before the vectorized ranking, kept as a reference"""
+    companies_perf_list = companies_perf.values()
+
+    for sector, sector_perf in sectors_perf.items():
+        fields = CompanyQuerySet.changes
+        if 'sector_change_custom' in sector_perf:
+            fields = chain(fields, ['change_custom'])
+        for field in fields:
+            lst = list(sorted(filter(lambda x: x.get('sector') == sector and not x.get(field) is None,
+                                     companies_perf_list), key=lambda y: y.get(field), reverse=True))
+            bot = reversed(lst[-top:])
+            tops = lst[:top]
+
+            sector_perf[f'bot_{field}'] = list(map(lambda x: (x['code'], round((x[field] - 1) * 100, 1)), bot))
+            sector_perf[f'top_{field}'] = list(map(lambda x: (x['code'], round((x[field] - 1) * 100, 1)), tops))
+
+
+def legacy_sector_changes(companies_perf: dict, custom_since=None, custom_to=None) -> dict:
+    """Nested loops summing sector values used before the groupby, kept as a reference"""
+    sector_fields = SECTOR_VALUE_FIELDS
+    sectors_perf = {}
+    for perf in companies_perf.values():
+        sectors_perf[perf['sector']] = {}
+    for sector_perf in sectors_perf.values():
+        sector_perf['sector_value_today'] = 0
+        if custom_since:
+            sector_perf['sector_value_custom'] = 0
+            if custom_to:
+                sector_perf['sector_value_custom_to'] = 0
+        for sector_field in sector_fields:
+            sector_perf[sector_field] = 0
+
+    for perf in companies_perf.values():
+        sector_perf = sectors_perf[perf['sector']]
+        shares = perf.get('shares')
+        cur_price = perf.get('current_price')
+        if not (shares and cur_price):
+            continue
+        if perf.get('change_custom'):
+            custom_price = perf.get('custom_price') or cur_price
+            sector_perf['sector_value_custom'] += round(shares * custom_price / perf['change_custom'], 4)
+            if custom_to:
+                sector_perf['sector_value_custom_to'] += round(shares * custom_price, 4)
+        sector_perf['sector_value_today'] += round(shares * cur_price, 4)
+        for sector_field, change_field in zip(sector_fields, CompanyQuerySet.changes):
+            if not perf.get(change_field):
+                continue
+            sector_perf[sector_field] += round(shares * cur_price / perf[change_field], 4)
+
+    for perf in sectors_perf.values():
+        if perf.get('sector_value_custom'):
+            if 'sector_value_custom_to' in perf:
+                perf['sector_change_custom'] = round(
+                    (perf['sector_value_custom_to'] / perf['sector_value_custom'] - 1) * 100, 1)
+            else:
+                perf['sector_change_custom'] = round(
+                    (perf['sector_value_today'] / perf['sector_value_custom'] - 1) * 100, 1)
+        else:
+            perf['sector_change_custom'] = None
+        for change_field, sector_field in zip(CompanyQuerySet.sector_changes, sector_fields):
+            if not perf[sector_field]:
+                perf[change_field] = None
+                continue
+            perf[change_field] = round((perf['sector_value_today'] / perf[sector_field] - 1) * 100, 1)
+    return sectors_perf
+
+
+def legacy_rates_per_day(when: date | None = None) -> list[dict]:
+    """Yield curves picked from the whole rates history used before offset lookups, kept as a reference"""
+    fields = TreasuryRates.get_fields_list()
+    res = list(map(TreasuryRates.serialize_per_day, TreasuryRates.objects.order_by('-date').values(*fields)))
+    full_res = []
+    if when:
+        custom_res = TreasuryRates.objects.filter(date=when).values(*fields).first()
+        if custom_res:
+            custom_res = TreasuryRates.serialize_per_day(custom_res)
+            custom_res['label'] = custom_res['label'] + ' (Custom)'
+            full_res.append(custom_res)
+    for period, offset in RATES_PER_DAY_OFFSETS.items():
+        if len(res) <= offset:
+            break
+        day_stat = res[offset]
+        day_stat['label'] = day_stat['label'] + f' ({period})'
+        full_res.append(day_stat)
+    return full_res
+
+
+async def load_test(paths: list[str], concurrency: int) -> tuple[list[float], float]:
+    """Request paths through the ASGI handler in-process with limited concurrency, return latencies and wall time"""
+    client = AsyncClient()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(path: str) -> float:
+        async with semaphore:
+            start = perf_counter()
+            response = await client.get(path)
+            if response.status_code != 200:
+                raise CommandError(f'Request to {path} failed with status {response.status_code}')
+            return perf_counter() - start
+
+    start = perf_counter()
+    latencies = await asyncio.gather(*map(request, paths))
+    return latencies, perf_counter() - start
+
+
+class BenchmarkExecutor:
+    """Run performance benchmarks on synthetic data"""
+    types = ['pricechanges', 'downsampling', 'asgi', 'parsing', 'pricescleaning', 'pricechangesql',
+             'outstanding', 'sectorchanges', 'ratesperday', 'pricestore']
+
+    @classmethod
+    def execute(cls, bench_type: str):
+        """Fetch option and run specified benchmark"""
+        if bench_type not in cls.types:
+            raise CommandError(f'Wrong benchmark type: {bench_type}')
+        res = getattr(cls, f'bench_{bench_type}')()
+        logger.info(res)
+
+    @classmethod
+    def bench_pricechanges(cls) -> str:
+        """Compare per-company loop against the matrix engine on 500 companies x 400 days"""
+        df = synthetic_prices(500, 400)
+        companies = [(pk, f'C{pk}', f'sector{pk % 11}') for pk in range(1, 501)]
+
+        legacy = measure(lambda: legacy_price_changes(df, companies, 200, 20), repeat=1)
+        engine = measure(lambda: compute_price_changes(df, 'company', 200, 20))
+        return (f'Price changes for 500 companies x 400 days:\n'
+                f'per-company loop - {legacy:.1f} ms, matrix engine - {engine:.1f} ms ({legacy / engine:.0f}x)\n')
+
+    @classmethod
+    def bench_downsampling(cls) -> str:
+        """Reduce yields for every business day since 1990 to 30 and 500 points"""
+        rates = synthetic_rates()
+        res = [f'Downsampling {len(rates)} days of rates:']
+        for limit in [30, 500]:
+            for mode in ['uniform', 'lttb']:
+                res.append(f'{mode} to {limit} points - {measure(lambda: downsample_rates(rates, limit, mode)):.1f} ms')
+        return '\n'.join(res) + '\n'
+
+    @classmethod
+    def bench_asgi(cls) -> str:
+        """Load test report pages served by async views under growing concurrency, needs a synced database"""
+        res = ['Report pages served in-process by the ASGI handler:']
+        with override_settings(ALLOWED_HOSTS=['*']):
+            for concurrency in [1, 10, 50]:
+                # Distinct custom ranges miss the reports cache, so every sectors request computes reports
+                paths = [f'/sectors?since={(date.today() - timedelta(days=30 + i)).strftime("%d/%m/%Y")}'
+                         for i in range(concurrency * 2)] + ['/yield-per-maturity?limit=100'] * concurrency * 2
+                latencies, elapsed = asyncio.run(load_test(paths, concurrency))
+                p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+                res.append(f'concurrency {concurrency} - {len(paths) / elapsed:.1f} requests/s, '
+                           f'latency p50 {p50:.0f} ms, p95 {p95:.0f} ms')
+        return '\n'.join(res) + '\n'
+
+    @classmethod
+    def bench_parsing(cls) -> str:
+        """Parse a synthetic top500 page and a synthetic shares outstanding page, the latter 500 times as a sync does"""
+        top500 = synthetic_top500_page()
+        shares = synthetic_shares_page()
+        res = ['Parsing synthetic pages with the markup of scraped sites, BeautifulSoup vs lxml XPath:']
+        pages = [('top500 page', top500, legacy_parse_top500, parse_top500, 1),
+                 ('500 shares pages', shares, legacy_parse_shares, parse_shares, 500)]
+        for name, page, legacy, parser, repeat in pages:
+            legacy_time = measure(lambda: [legacy(page) for _ in range(repeat)], repeat=1)
+            parser_time = measure(lambda: [parser(page) for _ in range(repeat)], repeat=3)
+            res.append(f'{name} - {legacy_time:.1f} ms vs {parser_time:.1f} ms ({legacy_time / parser_time:.0f}x)')
+        return '\n'.join(res) + '\n'
+
+    @classmethod
+    def bench_pricescleaning(cls) -> str:
+        """Clean a 25 years history of daily prices, alone and together with reading the CSV"""
+        csv_text = synthetic_prices_csv()
+        raw = pd.read_csv(StringIO(csv_text), dtype=PRICES_DTYPES)
+        legacy = measure(lambda: legacy_clean_prices(raw))
+        vectorized = measure(lambda: clean_prices(raw))
+        legacy_total = measure(lambda: legacy_clean_prices(pd.read_csv(StringIO(csv_text))))
+        vectorized_total = measure(lambda: parse_prices(csv_text))
+        return (f'Cleaning {len(raw.index)} rows of daily prices:\n'
+                f'element-wise - {legacy:.1f} ms, vectorized - {vectorized:.1f} ms ({legacy / vectorized:.0f}x)\n'
+                f'with reading CSV - {legacy_total:.1f} ms vs {vectorized_total:.1f} ms '
+                f'({legacy_total / vectorized_total:.0f}x)\n')
+
+    @classmethod
+    def bench_pricechangesql(cls) -> str:
+        """Compare window subqueries over price history against offset lookups, needs a synced database"""
+        companies = Company.objects.last_top500()
+        fields = ['pk', 'current_price', *CompanyQuerySet.changes]
+        subqueries = measure(lambda: list(companies.annotate_prices().annotate_price_changes().values(*fields)),
+                             repeat=1)
+        lookups = measure(lambda: companies.get_price_changes(), repeat=3)
+        return (f'Price changes of {companies.count()} companies on {connection.vendor}:\n'
+                f'window subqueries - {subqueries:.1f} ms, offset lookups - {lookups:.1f} ms '
+                f'({subqueries / lookups:.0f}x)\n')
+
+    @classmethod
+    def bench_outstanding(cls) -> str:
+        """Rank best and worst companies per sector for 500 and 5000 companies"""
+        res = ['Top and bottom companies per sector, per-sector sorting vs vectorized ranking:']
+        for companies in [500, 5000]:
+            sectors_perf, companies_perf = synthetic_sectors_perf(companies)
+            legacy = measure(lambda: legacy_sector_outstanding(sectors_perf, companies_perf))
+            vectorized = measure(lambda: get_sector_outstanding(sectors_perf, companies_perf))
+            res.append(f'{companies} companies - {legacy:.1f} ms vs {vectorized:.1f} ms ({legacy / vectorized:.1f}x)')
+        return '\n'.join(res) + '\n'
+
+    @classmethod
+    def bench_sectorchanges(cls) -> str:
+        """Sum sector values and changes for a custom range for 500, 5000 and 50000 companies"""
+        res = ['Sector values and changes, nested loops vs groupby:']
+        since, to = date.today() - timedelta(days=200), date.today() - timedelta(days=20)
+        for companies in [500, 5000, 50000]:
+            _, companies_perf = synthetic_sectors_perf(companies)
+            legacy = measure(lambda: legacy_sector_changes(companies_perf, since, to))
+            grouped = measure(lambda: compute_sector_changes(companies_perf, since, to))
+            res.append(f'{companies} companies - {legacy:.1f} ms vs {grouped:.1f} ms ({legacy / grouped:.1f}x)')
+        return '\n'.join(res) + '\n'
+
+    @classmethod
+    def bench_ratesperday(cls) -> str:
+        """Pick yield curves for periods and a custom date from the whole history or by offsets, needs synced rates"""
+        when = TreasuryRates.objects.order_by('date').values_list('date', flat=True).first()
+        legacy = measure(lambda: legacy_rates_per_day(when))
+        lookups = measure(lambda: get_rates_per_day(when))
+        return (f'Yield curves per day from {TreasuryRates.objects.count()} days of rates on {connection.vendor}:\n'
+                f'whole history - {legacy:.1f} ms, offset lookups - {lookups:.1f} ms ({legacy / lookups:.0f}x)\n')
+
+    @classmethod
+    def bench_pricestore(cls) -> str:
+        """Compute custom range price changes with prices from the database and from the store, needs synced prices"""
+        companies = Company.objects.last_top500()
+        since = date.today() - timedelta(days=200)
+
+        def changes() -> None:
+            get_shares_per_company(get_price_changes_per_company(companies, since, None))
+
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(PRICE_STORE_DIR=''):
+                database = measure(changes, repeat=3)
+            with override_settings(PRICE_STORE_DIR=directory):
+                start = perf_counter()
+                rows = write_price_store(Path(directory))
+                written = (perf_counter() - start) * 1000
+                get_price_store()  # Maps the store as a worker does on its first report
+                store = measure(changes, repeat=3)
+        return (f'Price changes for a custom range of {companies.count()} companies on {connection.vendor}:\n'
+                f'database - {database:.1f} ms, memory-mapped store - {store:.1f} ms ({database / store:.0f}x), '
+                f'store of {rows} prices written in {written:.0f} ms\n')
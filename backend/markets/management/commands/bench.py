@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandParser
+
+from markets.management.benchmarks import BenchmarkExecutor
+
+
+class Command(BaseCommand):
+    help = 'Run performance benchmarks'
+    requires_system_checks = []
+    suppressed_base_arguments = {'--version', '--verbosity', '--settings', '--pythonpath', '--traceback', '--no-color',
+                                 '--force-color', '--skip-checks'}
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('type', choices=BenchmarkExecutor.types)
+
+    def handle(self, *args, **options):
+        BenchmarkExecutor.execute(options['type'])
@@ -0,0 +1,20 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from markets.management.exports import CHUNK_SIZE, TABLES, export_tables
+
+
+class Command(BaseCommand):
+    help = 'Export market data tables to Parquet files'
+    requires_system_checks = []
+    suppressed_base_arguments = {'--version', '--verbosity', '--settings', '--pythonpath', '--traceback', '--no-color',
+                                 '--force-color', '--skip-checks'}
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('directory', type=Path, help='New or empty directory to write files to')
+        parser.add_argument('--tables', nargs='+', choices=list(TABLES), help='Tables to export, all by default')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Rows read and written at once')
+
+    def handle(self, *args, **options):
+        export_tables(options['directory'], options['tables'], options['chunk_size'])
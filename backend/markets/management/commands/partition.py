@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandParser
+
+from markets.management.partitions import partition_table
+from markets.models import YahooStockPrice, YahooAssetPrice
+
+
+class Command(BaseCommand):
+    help = 'Partition price tables by year (PostgreSQL only)'
+    requires_system_checks = []
+    suppressed_base_arguments = {'--version', '--verbosity', '--settings', '--pythonpath', '--traceback', '--no-color',
+                                 '--force-color', '--skip-checks'}
+    models = {'stockprices': YahooStockPrice, 'assetprices': YahooAssetPrice}
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('type', choices=list(self.models))
+        parser.add_argument('--dry-run', action='store_true', help='Show statements without running them')
+
+    def handle(self, *args, **options):
+        statements = partition_table(self.models[options['type']], options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write(';\n'.join(statements) + ';')
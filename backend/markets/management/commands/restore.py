@@ -0,0 +1,21 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from markets.management.exports import CHUNK_SIZE, TABLES, restore_tables
+
+
+class Command(BaseCommand):
+    help = 'Restore market data tables exported to Parquet files, rows already stored are skipped'
+    requires_system_checks = []
+    suppressed_base_arguments = {'--version', '--verbosity', '--settings', '--pythonpath', '--traceback', '--no-color',
+                                 '--force-color', '--skip-checks'}
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('directory', type=Path, help='Directory written by the export command')
+        parser.add_argument('--tables', nargs='+', choices=list(TABLES),
+                            help='Tables to restore, all exported by default')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Rows read and loaded at once')
+
+    def handle(self, *args, **options):
+        restore_tables(options['directory'], options['tables'], options['chunk_size'])
@@ -11,6 +11,8 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser: CommandParser):
         parser.add_argument('type', choices=SyncExecutor.types)
+        parser.add_argument('--parallel', type=int, help='Number of independent stages run at once')
+        parser.add_argument('--dry-run', action='store_true', help='Show stages plan without running it')
 
     def handle(self, *args, **options):
-        SyncExecutor.execute(options['type'])
+        SyncExecutor.execute(options['type'], options['parallel'], options['dry_run'])
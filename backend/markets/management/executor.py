@@ -1,20 +1,35 @@
 import logging
+from collections import defaultdict
 from datetime import datetime, date, timedelta
 from enum import Enum
+from io import StringIO
+from pathlib import Path
+from time import perf_counter
 from typing import Optional
 
+import numpy as np
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from django.conf import settings
 from django.core.management import CommandError
 from django.db import transaction
-from django.db.models import QuerySet
-from pandas import Series
+from django.db.models import QuerySet, Max, Q
+from django.utils import timezone
 
 from config.data_sources import us_treasury_monthly_rates, us_treasury_yearly_rates, company_asset_filename, \
     top500_url, company_details_url, yahoo_finance_url, local_codes_to_yahoo
 from config.settings import ROOT_DIR
-from markets.models import TreasuryRates, Company, Top500, Share, Asset, YahooAssetPrice, YahooStockPrice, Model
+from markets.cache import invalidate_reports, get_cache_stats, is_shared_cache
+from markets.helpers import merge_ranges, subtract_ranges
+from markets.management.fetcher import FetchStats, fetch_concurrently, http_get
+from markets.management.loaders import bulk_load
+from markets.management.parsers import parse_top500, parse_shares, parse_prices
+from markets.management.partitions import ensure_partitions
+from markets.management.pipeline import Pipeline, Stage
+from markets.models import TreasuryRates, Company, Top500, Share, Asset, YahooAssetPrice, YahooStockPrice, Model, \
+    SyncCheckpoint, StockPriceCoverage, AssetPriceCoverage
+from markets.reports import refresh_price_snapshots
+from markets.store import write_price_store
 
 logger = logging.getLogger('django-sync')
 
@@ -45,19 +60,29 @@ class TreasuryParYieldAdapter:
         '30 Yr': 'year30',
     }
     transforms = {
-        'date': lambda x: datetime.strptime(x, '%m/%d/%Y')
+        'date': lambda column: pd.to_datetime(column, format='%m/%d/%Y').dt.date
     }
 
     @classmethod
-    def validate_and_store(cls, row: Series) -> bool:
-        # Retrieve and prepare data from a row
-        row_dict = {value: row.get(key) for key, value in cls.column_to_field_map.items()}
-        # Make transforms
-        for t, func in cls.transforms.items():
-            row_dict[t] = func(row_dict[t])
-        # Update or create a record in DB
-        res = cls.model.objects.update_or_create(date=row_dict['date'], defaults=row_dict)
-        return res[1]
+    def transform(cls, rates: pd.DataFrame) -> pd.DataFrame:
+        """Map CSV columns to model fields and transform them column-wise"""
+        # Older archives lack some maturities, those are left empty
+        rates = rates.reindex(columns=list(cls.column_to_field_map)).rename(columns=cls.column_to_field_map)
+        for field, func in cls.transforms.items():
+            rates[field] = func(rates[field])
+        return rates.astype(object).where(rates.notna(), None)
+
+    @classmethod
+    def validate_and_store(cls, rates: pd.DataFrame) -> tuple[int, int]:
+        """Upsert all rows of a CSV at once, return numbers of total and newly created records"""
+        rates = cls.transform(rates)
+        existing = cls.model.objects.filter(date__in=list(rates['date'])).count()
+        fields = list(cls.column_to_field_map.values())
+        cls.model.objects.bulk_create(  # DB bulk upsert
+            [cls.model(**row) for row in rates.to_dict('records')],
+            update_conflicts=True, unique_fields=['date'], update_fields=[f for f in fields if f != 'date']
+        )
+        return len(rates.index), len(rates.index) - existing
 
 
 class TreasuryRatesSyncer:
@@ -69,36 +94,52 @@ class TreasuryRatesSyncer:
     yearly_url = us_treasury_yearly_rates
 
     @classmethod
-    def sync_bonds(cls, rate_type: TreasuryRatesType, year: int, month: Optional[int] = None) -> None:
-        """Sync treasure rates for given year or month"""
+    def archive_url(cls, rate_type: TreasuryRatesType, year: int, month: Optional[int] = None) -> str:
         if month:
-            url = cls.monthly_url.format(f'{year}{month:02}', rate_type.value)
-        else:
-            url = cls.yearly_url.format(year, rate_type.value)
+            return cls.monthly_url.format(f'{year}{month:02}', rate_type.value)
+        return cls.yearly_url.format(year, rate_type.value)
+
+    @classmethod
+    def sync_bonds(cls, rate_type: TreasuryRatesType, year: int, month: Optional[int] = None) -> int:
+        """Sync treasure rates for given year or month"""
+        return cls.sync_archives(rate_type, [(year, month)])
 
-        logger.info(f'Downloading rates CSV archive for year {year}{" month " + str(month) if month else ""}')
-        rates = pd.read_csv(url)
+    @classmethod
+    def sync_archives(cls, rate_type: TreasuryRatesType, periods: list[tuple[int, Optional[int]]],
+                      workers: Optional[int] = None) -> int:
+        """Download rates archives for given (year, month) periods concurrently and sync them one by one
 
+        Returns the number of inserted rates.
+        """
         adapter = cls.rates_types_to_adapter.get(rate_type)
         if not adapter:
             raise CommandError(f'No database model/adapter found for given rates type: {rate_type}')
 
-        logger.info('Processing started')
-        total = 0  # Number of rows in CSV
-        created = 0  # Number of new DB records created
-        with transaction.atomic():  # Single commit to DB for all the writes
-            for total, row in enumerate(rates.iterrows(), 1):
-                created += adapter.validate_and_store(row[1])
-
-        logger.info(f'Rates were synced with US Treasury.\n'
-                    f'Total records found - {total}, Inserted new records - {created}')
+        logger.info(f'Downloading {len(periods)} rates CSV archives')
+        tasks = [(period, cls.archive_url(rate_type, *period)) for period in periods]
+        stats = FetchStats()
+        inserted = 0
+        fetched = fetch_concurrently(tasks, lambda text: pd.read_csv(StringIO(text)),
+                                     workers or settings.SYNC_WORKERS, settings.SYNC_RATE_LIMIT, stats=stats)
+        for (year, month), rates, error in fetched:
+            archive = f'year {year}{" month " + str(month) if month else ""}'
+            if error:
+                logger.warning(f'Failed to download rates CSV archive for {archive}: {error}')
+                continue
+            with transaction.atomic():  # Single commit to DB for all the writes
+                total, created = adapter.validate_and_store(rates)
+            inserted += created
+            logger.info(f'Rates for {archive} were synced with US Treasury.\n'
+                        f'Total records found - {total}, Inserted new records - {created}')
+        logger.info(stats.summary())
+        return inserted
 
 
 class CompanyAssetSyncer:
     companies_file = ROOT_DIR / company_asset_filename
 
     @classmethod
-    def sync_localassets(cls) -> None:
+    def sync_localassets(cls) -> int:
         if not cls.companies_file.exists():
             raise CommandError(f'File with companies and assets not found in path: {cls.companies_file}')
         logger.info(f'Syncing companies and assets from file: {company_asset_filename}')
@@ -111,6 +152,7 @@ class CompanyAssetSyncer:
             update_conflicts=True, update_fields=['sector', 'name'], unique_fields=['code']
         )
         logger.info(f'Companies were synced\nInserted/updated {len(res)} records out of total {total}\n')
+        synced = len(res)
 
         assets_df = pd.read_excel(cls.companies_file, sheet_name='assets')
 
@@ -121,81 +163,118 @@ class CompanyAssetSyncer:
             update_conflicts=True, update_fields=['name'], unique_fields=['code']
         )
         logger.info(f'Assets were synced\nInserted/updated {len(res)} records out of total {total}\n')
+        return synced + len(res)
 
 
 class MarketSharesSyncer:
+    prices_url = yahoo_finance_url
+    shares_url = company_details_url
+    shares_stage = 'shares'
+    shares_chunk_size = 50  # Number of companies to store shares for at once
+    shares_fresh_period = timedelta(days=30)  # Skip companies with a share count reported within the period
+    shares_checkpoint_period = timedelta(hours=20)  # Skip companies processed by an interrupted run
+    coverage_models = {'company': StockPriceCoverage, 'asset': AssetPriceCoverage}
+    history_days = 365 * 25  # Period of prices history to sync
+    overlap_days = 3  # Days fetched before a missing date range
+    # Longer ranges with no prices are repaired. Prices are resampled daily only within a fetched CSV, so shorter
+    # ones are left between separate fetches, e.g. from a Friday ending one to a Tuesday after a holiday starting next
+    gap_days = 5
     headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 '
                              '(KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
 
     @classmethod
-    def sync_top500(cls) -> None:
+    def sync_top500(cls) -> int:
         """Sync today's top500 companies"""
         logger.info('Syncing top500')
-        data = requests.get(top500_url, headers=cls.headers).text
-        soup = BeautifulSoup(data, 'lxml')
-        top500_list = []  # Company codes
-        tbody = soup.select_one('div.col-lg-7 tbody')
-
-        for row in tbody.find_all('tr'):  # Find and collect all present companies
-            cols = row.find_all('td')
-            top500_list.append(cols[2].next.text.upper())
+        data = http_get(top500_url, headers=cls.headers)
+        top500_list = parse_top500(data)  # Company codes
 
         companies = Company.objects.filter(code__in=top500_list)
         res = Top500.objects.bulk_create(
             [Top500(company=company, date=date.today()) for company in companies], ignore_conflicts=True)
         logger.info(f'Synced {len(res)} companies of today\'s top500')
+        return len(res)
 
     @classmethod
-    def sync_shares_count(cls) -> None:
-        """Sync share counts for the last available top500"""
+    def sync_shares_count(cls, workers: Optional[int] = None, rate: Optional[float] = None,
+                          synced_companies: Optional[set[int]] = None) -> int:
+        """Sync share counts for the last available top500, return the number of stored share counts
+
+        Pages are fetched concurrently and stored in chunks together with checkpoints, so a run interrupted by
+        the site's request limitations resumes from companies not processed yet. Companies with a recent
+        share count or processed recently are skipped. Snapshots of synced companies are refreshed, unless
+        `synced_companies` is given to collect them for a later snapshots stage.
+        """
         logger.info('Syncing shares count for current top500 companies')
-        share_obj_list = []
         last_top500 = Company.objects.last_top500()
-        not_found = []
+        now = timezone.now()
+        fresh_companies = Share.objects.filter(date__gte=now.date() - cls.shares_fresh_period).values('company')
+        done_companies = SyncCheckpoint.objects.filter(
+            stage=cls.shares_stage, synced__gte=now - cls.shares_checkpoint_period).values('company')
+        companies = last_top500.exclude(pk__in=fresh_companies).exclude(pk__in=done_companies)
 
         total = last_top500.count()
-        updated = 0
-        logger.info(f'Going to fetch and process data for {total} companies')
-        for index, company in enumerate(last_top500):
-            url = company_details_url.format(company.code)
-            try:  # Exceeding the site's request limitations
-                data = requests.get(url).text
-            except requests.TooManyRedirects:
+        pending = list(companies)
+        logger.info(f'Going to fetch and process data for {len(pending)} companies, '
+                    f'{total - len(pending)} are fresh or done by a previous run')
+        not_found = []
+        synced = []
+        chunk = []  # Companies and their parsed shares waiting to be stored
+        rows = 0
+        broke = None
+
+        tasks = [(company, cls.shares_url.format(company.code)) for company in pending]
+        stats = FetchStats()
+        fetched = fetch_concurrently(tasks, parse_shares, workers or settings.SYNC_WORKERS,
+                                     rate or settings.SYNC_RATE_LIMIT, stats=stats)
+        for company, shares, error in fetched:
+            if isinstance(error, requests.TooManyRedirects):  # Exceeding the site's request limitations
                 broke = company.code
+                fetched.close()
                 break
-            soup = BeautifulSoup(data, 'lxml')
-
-            tbody = soup.find_all('tbody')
-            if not tbody:  # No table for a company on the site
+            if error:
+                logger.warning(f'Failed to fetch share count for {company.code}: {error}')
+                continue
+            if shares is None:
                 logger.warning(f'No table with share details found on site for company {company.code}')
                 not_found.append(company.code)
-                continue
-            table = tbody[1]
-            for row in table.find_all('tr'):
-                cols = row.find_all('td')
-                report_date = datetime.strptime(cols[0].text, '%Y-%m-%d').date()
-                try:  # Sometimes the table on the site have rows with no count for a date
-                    count = int(cols[1].text.replace(',', ''))
-                except ValueError:
-                    continue
-                share_obj_list.append(Share(company=company, date=report_date, count=count))
-            updated += 1
-            if index and not index % 50:
-                logger.info(f'Synced shares count for {index} out of {total} companies')
-        else:  # No breaks
-            broke = None
+            chunk.append((company, shares or []))
+            rows += len(shares or [])
+            if len(chunk) >= cls.shares_chunk_size:
+                synced.extend(cls.store_shares(chunk))
+                chunk = []
+                logger.info(f'Synced shares count for {len(synced)} out of {len(pending)} companies')
+        synced.extend(cls.store_shares(chunk))
+
         if broke:
             logger.warning(f'Syncing was stopped while dealing with company {broke}". '
-                           f'It\'s probably because of site\'s request limitations')
-        Share.objects.bulk_create(share_obj_list, ignore_conflicts=True)
-        logger.info(f'Synced shares for {updated} companies out of {total}.')
+                           f'It\'s probably because of site\'s request limitations. Next run resumes from here')
+        logger.info(stats.summary())
+        logger.info(f'Synced shares for {len(synced) - len(not_found)} companies out of {total}.')
         logger.warning("Not found share count for: " + ", ".join(not_found)) if not_found else None
+        cls.refresh_synced(synced, synced_companies)
+        return rows
 
-    @staticmethod
-    def cast_dataframe(series: Series):
-        if series.name == 'volume':
-            return series.apply(int)
-        return series.apply(lambda x: round(float(x), 4))
+    @classmethod
+    def refresh_synced(cls, synced: list[int], synced_companies: Optional[set[int]]) -> None:
+        """Refresh snapshots of companies with new data, or collect them for a later snapshots stage"""
+        if synced_companies is None:
+            cls.sync_snapshots(Company.objects.filter(pk__in=synced))
+        else:
+            synced_companies.update(synced)  # A single call is atomic for stages running in parallel threads
+
+    @classmethod
+    def store_shares(cls, chunk: list[tuple[Company, list[tuple[date, int]]]]) -> list[int]:
+        """Store share counts of processed companies together with their checkpoints"""
+        now = timezone.now()
+        with transaction.atomic():
+            Share.objects.bulk_create(
+                [Share(company=company, date=report_date, count=count)
+                 for company, shares in chunk for report_date, count in shares], ignore_conflicts=True)
+            SyncCheckpoint.objects.bulk_create(
+                [SyncCheckpoint(stage=cls.shares_stage, company=company, synced=now) for company, _ in chunk],
+                update_conflicts=True, unique_fields=['stage', 'company'], update_fields=['synced'])
+        return [company.pk for company, _ in chunk]
 
     @classmethod
     def transform_code(cls, code: str) -> str:
@@ -211,143 +290,276 @@ class MarketSharesSyncer:
         return code
 
     @classmethod
-    def sync_assetprices(cls) -> None:
+    def sync_snapshots(cls, companies: QuerySet) -> int:
+        """Refresh precomputed price changes for given companies"""
+        updated = refresh_price_snapshots(companies)
+        logger.info(f'Refreshed price change snapshots for {updated} companies')
+        return updated
+
+    @classmethod
+    def sync_assetprices(cls) -> int:
         query = Asset.objects.all()
-        cls.base_sync_prices(query, 'asset', YahooAssetPrice)
+        _, rows = cls.base_sync_prices(query, 'asset', YahooAssetPrice)
+        return rows
 
     @classmethod
-    def sync_stockprices(cls) -> None:
+    def sync_stockprices(cls, synced_companies: Optional[set[int]] = None) -> int:
         last_top500 = Top500.objects.last_top500()
         query = Company.objects.filter(top500__in=last_top500)
-        cls.base_sync_prices(query, 'company', YahooStockPrice)
+        synced, rows = cls.base_sync_prices(query, 'company', YahooStockPrice)
+        cls.refresh_synced(synced, synced_companies)
+        return rows
+
+    @classmethod
+    def get_coverage(cls, query: QuerySet, item_name: str, price_model: type[Model]) -> dict[int, list]:
+        """Get date ranges prices were fetched for per item
+
+        Items with prices stored before coverage was tracked are considered covered since the start of
+        the history period up to their last price.
+        """
+        coverage_model = cls.coverage_models[item_name]
+        coverage = defaultdict(list)
+        for pk, since, to in coverage_model.objects.filter(**{f'{item_name}__in': query.values('pk')}) \
+                .values_list(item_name, 'since', 'to'):
+            coverage[pk].append((since, to))
+        last_dates = (  # Most recent stored price date per item in a single grouped query
+            price_model.objects.filter(**{f'{item_name}__in': query.values('pk')}).values(item_name)
+            .annotate(last_date=Max('date')).values_list(item_name, 'last_date')
+        )
+        history_start = date.today() - timedelta(days=cls.history_days)
+        for pk, last_date in last_dates:
+            if pk not in coverage:
+                coverage[pk] = [(min(history_start, last_date), last_date)]
+        return coverage
+
+    @classmethod
+    def store_coverage(cls, item_name: str, pk: int, ranges: list[tuple[date, date]]) -> None:
+        """Replace date ranges prices of an item were fetched for"""
+        coverage_model = cls.coverage_models[item_name]
+        coverage_model.objects.filter(**{item_name: pk}).delete()
+        coverage_model.objects.bulk_create(
+            [coverage_model(**{f'{item_name}_id': pk}, since=since, to=to) for since, to in ranges])
 
     @classmethod
-    def base_sync_prices(cls, query: QuerySet, item_name: str, price_model: type[Model], force: bool = False) -> None:
-        """Sync stock prices for top500 from Yahoo Finance"""
+    def base_sync_prices(cls, query: QuerySet, item_name: str, price_model: type[Model], force: bool = False,
+                         workers: Optional[int] = None, rate: Optional[float] = None) -> tuple[list[int], int]:
+        """Sync stock prices for top500 from Yahoo Finance, return primary keys of items with new prices and
+        the number of written rows
+
+        Only date ranges of the history period missing in the item's coverage are fetched, all of it if
+        forced. Prices are downloaded and parsed by a pool of `workers` threads with at most `rate` requests
+        per second, while writes to DB are done one by one in the calling thread.
+        """
         total = query.count()
         logger.info(f'Starting sync prices for {total} companies/assets')
         updated = 0
+        rows = 0
+        synced = []
         error_skipped = []
         already_fresh = []
+        tasks = []  # Pairs of (item, missing range) and URL to fetch prices from
+        coverage = {} if force else cls.get_coverage(query, item_name, price_model)
+        to = date.today() - timedelta(days=1)  # Prices for today are not final
+        history = [(date.today() - timedelta(days=cls.history_days), to)]
 
-        for updated, item in enumerate(query, 1):
+        for item in query:
             yahoo_code = item.code
             if item_name == 'company':
                 yahoo_code = local_codes_to_yahoo.get(item.code, cls.transform_code(item.code))
-            last_price = price_model.objects.filter(**{item_name: item}).order_by('-date').first()
-            to = datetime(*date.today().timetuple()[0:3])
-            since = to - timedelta(days=365 * 25)  # Fetch data for 25 years by default
-            if last_price:  # 3 days offset to interleave
-                since = datetime(*last_price.date.timetuple()[0:3]) - timedelta(days=3)
-            if force:
-                since = to - timedelta(days=365 * 25)  # Force fetching for 25 years
-            if to - since <= timedelta(days=4):  # Skip if period distance is less than 1 day
+            missing = subtract_ranges(history, coverage.get(item.pk, []))
+            if not missing:
                 already_fresh.append(item.code)
                 continue
-            url = yahoo_finance_url.format(yahoo_code, int(since.timestamp()), int(to.timestamp()))
-            try:
-                prices = pd.read_csv(url)
-            except requests.TooManyRedirects:
-                error_skipped.append([item.code])
+            for since, until in missing:  # Days of overlap to interpolate prices across range edges
+                period1 = datetime(*(since - timedelta(days=cls.overlap_days)).timetuple()[0:3])
+                period2 = datetime(*(until + timedelta(days=1)).timetuple()[0:3])
+                tasks.append(((item, since, until),
+                              cls.prices_url.format(yahoo_code, int(period1.timestamp()), int(period2.timestamp()))))
+        logger.info(f'Going to fetch {len(tasks)} missing date ranges')
+        if tasks:  # Overlap days may reach the year before the earliest missing range
+            first_year = min(since for (_, since, _), _ in tasks).year - 1
+            ensure_partitions(price_model, range(first_year, date.today().year + 1))
+
+        stats = FetchStats()
+        fetched = fetch_concurrently(tasks, parse_prices, workers or settings.SYNC_WORKERS,
+                                     rate or settings.SYNC_RATE_LIMIT, headers=cls.headers, stats=stats)
+        for (item, since, until), prices, error in fetched:
+            if error:
+                logger.warning(f'Failed to fetch prices for {item.code} from {since} to {until}: {error}')
+                error_skipped.append(item.code)
                 continue
-            # Process price DataFrame
-
-            prices.index = pd.DatetimeIndex(prices['Date'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d')))
-            prices = prices[~prices.index.duplicated(keep='first')]
-            prices.drop('Date', axis=1, inplace=True)
-            prices.columns = list(map(str.lower, prices.columns))
-            prices = prices.resample('D').interpolate(limit=30)
-            prices = prices.apply(cls.cast_dataframe)
-            prices.dropna(inplace=True)
-
-            stock_prices = [  # Building SQL QuerySet
-                price_model(
-                    date=row.Index.date(), open=row.open, high=row.high, low=row.low, close=row.close,
-                    volume=row.volume, **{item_name: item}) for row in prices.itertuples()
-            ]
-            price_model.objects.bulk_create(stock_prices, ignore_conflicts=True)
-            if updated and not updated % 50:
-                logger.info(f'Synced prices for {updated} {item_name}s')
-        logger.info(f'Synced prices for {updated} {item_name} of {query.count()}.\n'
+            frame = prices[['open', 'high', 'low', 'close', 'volume']].assign(**{f'{item_name}_id': item.pk})
+            frame.insert(0, 'date', prices.index.date)
+            coverage[item.pk] = merge_ranges([*coverage.get(item.pk, []), (since, until)])
+            with transaction.atomic():  # Prices and their coverage are stored together
+                rows += bulk_load(price_model, frame, unique_fields=['date', item_name])
+                cls.store_coverage(item_name, item.pk, coverage[item.pk])
+            if item.pk not in synced:
+                synced.append(item.pk)
+                updated += 1
+                if not updated % 50:
+                    logger.info(f'Synced prices for {updated} {item_name}s')
+        logger.info(stats.summary())
+        logger.info(f'Synced prices for {updated} {item_name} of {total}.\n'
                     f'{len(already_fresh)} {"".join(["[", " ,".join(already_fresh[:5]), "...", "]"])} '
                     f'{item_name}s are already up-to-date. {error_skipped} were skipped due to network errors')
+        return synced, rows
+
+    @classmethod
+    def find_gaps(cls, item_name: str, price_model: type[Model], pk: int) -> list[tuple[date, date]]:
+        """Find date ranges longer than `gap_days` with no prices between the first and the last price of an item"""
+        dates = np.array(price_model.objects.filter(**{item_name: pk}).order_by('date')
+                         .values_list('date', flat=True), dtype='datetime64[D]')
+        starts = np.flatnonzero(np.diff(dates) > np.timedelta64(cls.gap_days, 'D'))
+        return [((dates[start] + 1).item(), (dates[start + 1] - 1).item()) for start in starts]
+
+    @classmethod
+    def repair_prices(cls, query: QuerySet, item_name: str, price_model: type[Model]) -> tuple[list[int], int]:
+        """Remove gaps in stored prices from the coverage of items and backfill them"""
+        coverage = cls.get_coverage(query, item_name, price_model)
+        repaired = 0
+        for pk, ranges in coverage.items():
+            gaps = cls.find_gaps(item_name, price_model, pk)
+            if gaps:
+                cls.store_coverage(item_name, pk, subtract_ranges(ranges, gaps))
+                repaired += 1
+        logger.info(f'Found gaps in prices of {repaired} {item_name}s')
+        return cls.base_sync_prices(query, item_name, price_model)
 
 
 class SyncExecutor:
-    """Main sync executor"""
-    types = ['localassets', 'allrates', 'currentrates', 'top500', 'marketshares', 'prices', 'allmarkets', 'setup',
-             'daily']
+    """Main sync executor, every sync type is a pipeline of stages run in order of their dependencies"""
+    pipelines = {
+        'localassets': ['localassets'],
+        'allrates': ['allrates'],
+        'currentrates': ['currentrates'],
+        'top500': ['top500'],
+        'marketshares': ['marketshares', 'snapshots', 'pricestore'],
+        'prices': ['stockprices', 'assetprices', 'snapshots', 'pricestore'],
+        'allmarkets': ['top500', 'marketshares', 'stockprices', 'assetprices', 'snapshots', 'pricestore'],
+        'setup': ['localassets', 'setuprates', 'top500', 'marketshares', 'stockprices', 'assetprices', 'snapshots',
+                  'pricestore'],
+        'daily': ['currentrates', 'top500', 'marketshares', 'stockprices', 'assetprices', 'snapshots', 'pricestore'],
+        'snapshots': ['snapshots'],
+        'repair': ['repairprices', 'snapshots', 'pricestore'],
+        'pricestore': ['pricestore'],
+    }
+    types = list(pipelines)
+    # Stages writing share counts or stock prices, a snapshots stage after them refreshes only companies they synced
+    company_stages = ['marketshares', 'stockprices', 'repairprices']
+    # Stages a stage depends on when both are in a pipeline
+    dependencies = {
+        'top500': ['localassets'],
+        'marketshares': ['top500'],
+        'stockprices': ['top500'],
+        'assetprices': ['localassets'],
+        'snapshots': [*company_stages, 'pricestore'],  # Reads the store if enabled
+        'pricestore': company_stages,
+    }
+    # Companies synced by company stages of the running pipeline, None when it has none
+    synced_companies: Optional[set[int]] = None
+
+    @classmethod
+    def pipeline(cls, sync_type: str) -> Pipeline:
+        """Build pipeline of stages for a sync type"""
+        names = cls.pipelines[sync_type]
+        return Pipeline([Stage(name, getattr(cls, f'sync_{name}'),
+                               tuple(dep for dep in cls.dependencies.get(name, []) if dep in names))
+                         for name in names])
 
     @classmethod
-    def execute(cls, sync_type: list[str]):
+    def execute(cls, sync_type: str, parallel: Optional[int] = None, dry_run: bool = False):
         """Fetch option and run specified sync"""
         if sync_type not in cls.types:
             raise CommandError(f'Wrong sync type: {sync_type}')
-        res = getattr(cls, f'sync_{sync_type}')()
-        logger.info(res)
+        pipeline = cls.pipeline(sync_type)
+        parallel = parallel or settings.SYNC_PARALLEL
+        if dry_run:
+            logger.info(f'Sync {sync_type} plan with up to {parallel} stages at once:\n{pipeline.describe()}')
+            return
+
+        start = perf_counter()
+        cls.synced_companies = set() if set(cls.company_stages) & set(pipeline.stages) else None
+        try:
+            results = pipeline.run(parallel)
+        finally:
+            cls.synced_companies = None
+        logger.info(f'Sync {sync_type} finished in {perf_counter() - start:.1f}s:\n'
+                    + '\n'.join(map(str, results)))
+        if is_shared_cache():
+            stats = get_cache_stats()
+            logger.info(f'Reports cache before invalidation: {stats["hits"]} hits, {stats["misses"]} misses')
+        invalidate_reports(sync_type)
+        failed = [res.name for res in results if res.error or res.skipped]
+        if failed:
+            raise CommandError(f'Sync stages failed or skipped: {", ".join(failed)}')
 
     @classmethod
-    def sync_allrates(cls) -> str:
-        """Sync treasury rates for 3 years"""
+    def sync_localassets(cls) -> int:
+        return CompanyAssetSyncer.sync_localassets()
+
+    @classmethod
+    def sync_allrates(cls) -> int:
+        """Sync treasury rates for 15 years"""
         now = datetime.now()
-        [
-            TreasuryRatesSyncer.sync_bonds(TreasuryRatesType.ParYieldCurve, now.year - i) for i in range(15)
-        ]
-        return 'Sync rates for last three years finished\n'
+        return TreasuryRatesSyncer.sync_archives(TreasuryRatesType.ParYieldCurve,
+                                                 [(now.year - i, None) for i in range(15)])
 
     @classmethod
-    def sync_currentrates(cls) -> str:
+    def sync_setuprates(cls) -> int:
+        """Sync treasury rates since 1999"""
+        now = datetime.now()
+        return TreasuryRatesSyncer.sync_archives(TreasuryRatesType.ParYieldCurve,
+                                                 [(year, None) for year in range(now.year, 1998, -1)])
+
+    @classmethod
+    def sync_currentrates(cls) -> int:
         """Sync treasury rates for current month"""
         now = datetime.now()
-        TreasuryRatesSyncer.sync_bonds(TreasuryRatesType.ParYieldCurve, now.year, month=now.month)
-        return 'Sync rates for current month finished\n'
+        return TreasuryRatesSyncer.sync_bonds(TreasuryRatesType.ParYieldCurve, now.year, month=now.month)
 
     @classmethod
-    def sync_top500(cls) -> str:
-        MarketSharesSyncer.sync_top500()
-        return 'Sync top500 finished\n'
+    def sync_top500(cls) -> int:
+        return MarketSharesSyncer.sync_top500()
 
     @classmethod
-    def sync_marketshares(cls) -> str:
-        MarketSharesSyncer.sync_shares_count()
-        return 'Sync market shares count finished\n'
+    def sync_marketshares(cls) -> int:
+        return MarketSharesSyncer.sync_shares_count(synced_companies=cls.synced_companies)
 
     @classmethod
-    def sync_prices(cls) -> str:
-        MarketSharesSyncer.sync_stockprices()
-        MarketSharesSyncer.sync_assetprices()
-        return 'Sync shares and assets prices finished\n'
+    def sync_stockprices(cls) -> int:
+        return MarketSharesSyncer.sync_stockprices(synced_companies=cls.synced_companies)
 
     @classmethod
-    def sync_allmarkets(cls) -> str:
-        """Sync top500, share counts and market prices"""
-        logger.info('Starting all market values sync')
-        MarketSharesSyncer.sync_top500()
-        MarketSharesSyncer.sync_shares_count()
-        MarketSharesSyncer.sync_stockprices()
-        MarketSharesSyncer.sync_assetprices()
-        return 'Sync market shares finished\n'
+    def sync_assetprices(cls) -> int:
+        return MarketSharesSyncer.sync_assetprices()
 
     @classmethod
-    def sync_daily(cls) -> str:
-        res = cls.sync_currentrates()
-        logger.info(res)
-        return cls.sync_allmarkets()
+    def sync_repairprices(cls) -> int:
+        """Backfill gaps in stored stock and asset prices"""
+        last_top500 = Top500.objects.last_top500()
+        synced, stock_rows = MarketSharesSyncer.repair_prices(
+            Company.objects.filter(top500__in=last_top500), 'company', YahooStockPrice)
+        if cls.synced_companies is not None:
+            cls.synced_companies.update(synced)
+        _, asset_rows = MarketSharesSyncer.repair_prices(Asset.objects.all(), 'asset', YahooAssetPrice)
+        return stock_rows + asset_rows
 
     @classmethod
-    def sync_localassets(cls) -> str:
-        CompanyAssetSyncer.sync_localassets()
-        return 'Sync local companies and assets finished\n'
+    def sync_snapshots(cls) -> int:
+        """Refresh price change snapshots of the last top500 companies synced by the pipeline
+
+        Snapshots of all of them are rebuilt when the pipeline has no company stages, e.g. for the snapshots sync.
+        """
+        companies = Company.objects.last_top500()
+        if cls.synced_companies is not None:  # Companies new to the top500 have no snapshot yet
+            companies = companies.filter(Q(pk__in=cls.synced_companies) | Q(snapshot__isnull=True))
+        return MarketSharesSyncer.sync_snapshots(companies)
 
     @classmethod
-    def sync_setup(cls) -> str:
-        logger.info('Starting initial setup sync')
-        now = datetime.now()
-        CompanyAssetSyncer.sync_localassets()
-        [TreasuryRatesSyncer.sync_bonds(TreasuryRatesType.ParYieldCurve, i) for i in range(now.year, 1998, -1)]
-        MarketSharesSyncer.sync_top500()
-        MarketSharesSyncer.sync_shares_count()
-        MarketSharesSyncer.sync_stockprices()
-        MarketSharesSyncer.sync_assetprices()
-
-        return 'Initial setup sync finished\n'
+    def sync_pricestore(cls) -> int:
+        """Write stock prices and share counts to the store read by server workers"""
+        if not settings.PRICE_STORE_DIR:
+            logger.info('Price store is disabled, PRICE_STORE_DIR is not set')
+            return 0
+        return write_price_store(Path(settings.PRICE_STORE_DIR))
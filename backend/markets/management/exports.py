@@ -0,0 +1,123 @@
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import Iterator, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.core.management import CommandError
+from django.core.management.color import no_style
+from django.db import connection
+
+from markets.management.loaders import bulk_load
+from markets.models import Model, Company, Asset, Top500, Share, TreasuryRates, YahooStockPrice, YahooAssetPrice
+
+logger = logging.getLogger('django')
+
+# Exported tables with fields identifying a row, in order of restoring, tables referenced by foreign keys go first
+TABLES: dict[str, tuple[type[Model], list[str]]] = {
+    'companies': (Company, ['code']),
+    'assets': (Asset, ['code']),
+    'top500': (Top500, ['date', 'company']),
+    'shares': (Share, ['company', 'date']),
+    'treasuryrates': (TreasuryRates, ['date']),
+    'stockprices': (YahooStockPrice, ['date', 'company']),
+    'assetprices': (YahooAssetPrice, ['date', 'asset']),
+}
+# File listing exported tables, written last so an interrupted export is never restored
+MANIFEST_FILE = 'manifest.json'
+CHUNK_SIZE = 100_000
+
+
+def _columns(model: type[Model]) -> list[str]:
+    return [field.column for field in model._meta.concrete_fields]
+
+
+def _chunks(model: type[Model], chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Read a table in frames of at most `chunk_size` rows, with a server-side cursor on PostgreSQL"""
+    columns = _columns(model)
+    rows = model.objects.order_by('pk').values_list(*[field.attname for field in model._meta.concrete_fields])
+    chunk = []
+    for row in rows.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield pd.DataFrame(chunk, columns=columns)
+            chunk = []
+    if chunk:
+        yield pd.DataFrame(chunk, columns=columns)
+
+
+def export_table(model: type[Model], directory: Path, chunk_size: int = CHUNK_SIZE) -> int:
+    """Write a table to zstd compressed Parquet files, a file per chunk and year for tables with dates"""
+    rows = 0
+    for index, chunk in enumerate(_chunks(model, chunk_size)):
+        if 'date' in chunk.columns:  # Partitions in the hive layout, e.g. year=2023/part-00000.parquet
+            years = pd.to_datetime(chunk['date']).dt.year
+            partitions = [(directory / f'year={year}', part) for year, part in chunk.groupby(years)]
+        else:
+            partitions = [(directory, chunk)]
+        for path, part in partitions:
+            path.mkdir(parents=True, exist_ok=True)
+            pq.write_table(pa.Table.from_pandas(part, preserve_index=False), path / f'part-{index:05}.parquet',
+                           compression='zstd')
+        rows += len(chunk.index)
+    return rows
+
+
+def export_tables(directory: Path, tables: Optional[list[str]] = None,
+                  chunk_size: int = CHUNK_SIZE) -> dict[str, int]:
+    """Export market tables to a new directory, return numbers of exported rows per table"""
+    if directory.exists() and any(directory.iterdir()):
+        raise CommandError(f'Export directory {directory} is not empty')
+    manifest = {'exported': datetime.now().isoformat(), 'tables': {}}
+    for name in tables or TABLES:
+        model, _ = TABLES[name]
+        start = perf_counter()
+        rows = export_table(model, directory / name, chunk_size)
+        manifest['tables'][name] = {'rows': rows, 'columns': _columns(model)}
+        logger.info(f'Exported {rows} rows of {name} in {perf_counter() - start:.1f}s')
+    (directory / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+    return {name: table['rows'] for name, table in manifest['tables'].items()}
+
+
+def read_manifest(directory: Path) -> dict:
+    try:
+        return json.loads((directory / MANIFEST_FILE).read_text())
+    except FileNotFoundError:
+        raise CommandError(f'No complete export in {directory}, {MANIFEST_FILE} is missing')
+
+
+def restore_table(model: type[Model], unique_fields: list[str], directory: Path,
+                  chunk_size: int = CHUNK_SIZE) -> int:
+    """Bulk load Parquet files of a table batch by batch, rows already in the table are skipped"""
+    rows = 0
+    for path in sorted(directory.rglob('*.parquet')):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            rows += bulk_load(model, batch.to_pandas(), unique_fields)
+    return rows
+
+
+def restore_tables(directory: Path, tables: Optional[list[str]] = None,
+                   chunk_size: int = CHUNK_SIZE) -> dict[str, int]:
+    """Restore exported market tables, return numbers of loaded rows per table"""
+    manifest = read_manifest(directory)
+    names = [name for name in TABLES if name in (tables or manifest['tables'])]
+    missing = set(names) - set(manifest['tables'])
+    if missing:
+        raise CommandError(f'Tables are not in the export: {", ".join(sorted(missing))}')
+
+    res = {}
+    for name in names:
+        model, unique_fields = TABLES[name]
+        start = perf_counter()
+        res[name] = restore_table(model, unique_fields, directory / name, chunk_size)
+        logger.info(f'Restored {res[name]} of {manifest["tables"][name]["rows"]} exported rows of {name} '
+                    f'in {perf_counter() - start:.1f}s')
+    # Rows keep their exported ids, sequences continue after them for rows synced later
+    with connection.cursor() as cursor:
+        for statement in connection.ops.sequence_reset_sql(no_style(), [TABLES[name][0] for name in names]):
+            cursor.execute(statement)
+    return res
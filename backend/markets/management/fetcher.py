@@ -0,0 +1,151 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from time import monotonic, perf_counter, sleep, time
+from typing import Any, Callable, Iterable, Iterator, Optional
+from urllib.parse import urlsplit
+
+import numpy as np
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config.data_sources import cache_ttl
+
+# Sessions keep connections to data sources alive, one per thread as sessions are not thread-safe
+_sessions = threading.local()
+# Transient errors and rate limiting answers are retried with exponential backoff
+RETRY = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'],
+              raise_on_status=False)
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing out requests to a single host"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0  # Seconds between two requests, no limit for zero rate
+        self.next_slot = monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until the next request slot is available"""
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
+
+# Limiters are shared by all fetches, so stages syncing in parallel stay within a host's rate together
+_limiters: dict[tuple[str, float], RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Get HTTP session of the current thread with connection pooling and retries"""
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+        adapter = HTTPAdapter(max_retries=RETRY)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return session
+
+
+class ResponseCache:
+    """On-disk cache of response bodies keyed by SHA-256 of the URL, kept for a TTL of the URL's host"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    def path(self, url: str) -> Path:
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        return self.directory / urlsplit(url).netloc / digest[:2] / digest
+
+    def get(self, url: str) -> Optional[str]:
+        ttl = cache_ttl.get(urlsplit(url).netloc)
+        path = self.path(url)
+        try:
+            if not ttl or time() - path.stat().st_mtime > ttl:
+                return None
+            return path.read_text(encoding='utf-8')
+        except FileNotFoundError:
+            return None
+
+    def set(self, url: str, text: str) -> None:
+        if not cache_ttl.get(urlsplit(url).netloc):
+            return
+        path = self.path(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}')
+        temp.write_text(text, encoding='utf-8')
+        temp.replace(path)  # Readers never see a partially written body
+
+
+def http_get(url: str, headers: Optional[dict] = None, timeout: float = 60) -> str:
+    """Get body of a data source response, from the on-disk cache if it's enabled and fresh"""
+    cache = ResponseCache(Path(settings.HTTP_CACHE_DIR)) if settings.HTTP_CACHE_DIR else None
+    text = cache.get(url) if cache else None
+    if text is None:
+        response = get_session().get(url, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        text = response.text
+        if cache:
+            cache.set(url, text)
+    return text
+
+
+class FetchStats:
+    """Collect fetch latencies to report throughput and tail latency"""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.latencies = []
+
+    def add(self, latency: float) -> None:
+        self.latencies.append(latency)
+
+    def summary(self) -> str:
+        elapsed = perf_counter() - self.started
+        if not self.latencies:
+            return f'No items fetched in {elapsed:.1f}s'
+        p50, p95 = np.percentile(self.latencies, [50, 95])
+        return (f'Fetched {len(self.latencies)} items in {elapsed:.1f}s ({len(self.latencies) / elapsed:.1f} items/s), '
+                f'latency p50 {p50:.2f}s, p95 {p95:.2f}s, max {max(self.latencies):.2f}s')
+
+
+def fetch_concurrently(tasks: Iterable[tuple[Any, str]], parse: Callable[[str], Any], workers: int, rate: float,
+                       headers: Optional[dict] = None,
+                       stats: Optional[FetchStats] = None) -> Iterator[tuple[Any, Any, Optional[Exception]]]:
+    """Download and parse URLs in a thread pool, yield (key, parsed result, error) in order of completion
+
+    Downloads and parsing overlap in worker threads while the caller consumes results, so all database writes
+    stay in the calling thread. Requests to every host are spaced out to at most `rate` per second.
+    Closing the generator early cancels downloads not started yet.
+    """
+    def fetch(url: str) -> tuple[Any, float]:
+        host = urlsplit(url).netloc
+        with _limiters_lock:
+            limiter = _limiters.setdefault((host, rate), RateLimiter(rate))
+        limiter.wait()
+        start = perf_counter()
+        return parse(http_get(url, headers)), perf_counter() - start
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {pool.submit(fetch, url): key for key, url in tasks}
+        for future in as_completed(futures):
+            try:
+                result, latency = future.result()
+            except (requests.RequestException, ValueError) as error:
+                yield futures[future], None, error
+                continue
+            if stats:
+                stats.add(latency)
+            yield futures[future], result, None
+    finally:  # Pending downloads are dropped if the caller stops consuming results
+        pool.shutdown(cancel_futures=True)
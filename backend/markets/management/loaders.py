@@ -0,0 +1,87 @@
+from io import StringIO
+
+import pandas as pd
+from django.db import connection, transaction
+from django.db.models import DateTimeField, DateField
+
+from markets.models import Model
+
+
+def _missing_columns_defaults(model: type[Model], columns: list[str]) -> dict[str, str]:
+    """Get SQL defaults for auto-filled model columns absent in a frame"""
+    defaults = {}
+    for field in model._meta.concrete_fields:
+        if field.primary_key or field.column in columns:
+            continue
+        if isinstance(field, (DateTimeField, DateField)) and (field.auto_now or field.auto_now_add):
+            defaults[field.column] = 'now()' if isinstance(field, DateTimeField) else 'CURRENT_DATE'
+        elif not field.null:
+            raise ValueError(f'No data for required column {field.column} of {model._meta.db_table}')
+    return defaults
+
+
+def copy_load(model: type[Model], frame: pd.DataFrame, unique_fields: list[str], update: bool = False,
+              chunk_size: int = 100_000) -> int:
+    """Stream a frame with COPY into a staging table and merge it into the model table (PostgreSQL only)"""
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    staging = f'pg_temp.{qn(f"{table}_staging")}'  # Never a regular table of the same name on the search path
+    columns = list(frame.columns)
+    defaults = _missing_columns_defaults(model, columns)
+    conflict_columns = [model._meta.get_field(field).column for field in unique_fields]
+    created_columns = [field.column for field in model._meta.concrete_fields if getattr(field, 'auto_now_add', False)]
+
+    on_conflict = 'DO NOTHING'
+    if update:
+        on_conflict = 'DO UPDATE SET ' + ', '.join(
+            f'{qn(column)} = EXCLUDED.{qn(column)}' for column in [*columns, *defaults]
+            if column not in conflict_columns and column not in created_columns)
+    merge_sql = (
+        f'INSERT INTO {qn(table)} ({", ".join(map(qn, [*columns, *defaults]))}) '
+        f'SELECT {", ".join([*map(qn, columns), *defaults.values()])} FROM {staging} '
+        f'ON CONFLICT ({", ".join(map(qn, conflict_columns))}) {on_conflict}'
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {staging}')  # Left by a previous load in the same transaction
+        cursor.execute(f'CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS '
+                       f'SELECT {", ".join(map(qn, columns))} FROM {qn(table)} WITH NO DATA')
+        for start in range(0, len(frame.index), chunk_size):  # Bounded memory for the CSV buffer
+            buffer = StringIO()
+            frame.iloc[start:start + chunk_size].to_csv(buffer, header=False, index=False)
+            buffer.seek(0)
+            cursor.copy_expert(f'COPY {staging} ({", ".join(map(qn, columns))}) FROM STDIN WITH (FORMAT csv)',
+                               buffer)
+        cursor.execute(merge_sql)
+        return cursor.rowcount
+
+
+def chunked_bulk_create(model: type[Model], frame: pd.DataFrame, unique_fields: list[str], update: bool = False,
+                        chunk_size: int = 5_000) -> int:
+    """Insert a frame with bulk_create, building model objects for a single chunk at a time"""
+    update_fields = [field.name for field in model._meta.concrete_fields
+                     if not field.primary_key and field.name not in unique_fields
+                     and not getattr(field, 'auto_now_add', False)]
+    conflicts = {'update_conflicts': True, 'unique_fields': unique_fields, 'update_fields': update_fields} \
+        if update else {'ignore_conflicts': True}
+    total = 0
+    with transaction.atomic():
+        for start in range(0, len(frame.index), chunk_size):
+            chunk = frame.iloc[start:start + chunk_size]
+            chunk = chunk.astype(object).where(chunk.notna(), None)  # Missing values as NULLs
+            res = model.objects.bulk_create([model(**row) for row in chunk.to_dict('records')], **conflicts)
+            total += len(res)
+    return total
+
+
+def bulk_load(model: type[Model], frame: pd.DataFrame, unique_fields: list[str], update: bool = False) -> int:
+    """Bulk load a frame with columns named after model columns, skipping or updating conflicting rows
+
+    PostgreSQL loads go through COPY without building model objects, other databases fall back to
+    chunked bulk_create. Returns the number of rows inserted/updated (all rows for the fallback).
+    """
+    if frame.empty:
+        return 0
+    if connection.vendor == 'postgresql':
+        return copy_load(model, frame, unique_fields, update)
+    return chunked_bulk_create(model, frame, unique_fields, update)
@@ -0,0 +1,60 @@
+from datetime import date
+from io import StringIO
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from lxml import html as lxml_html
+from lxml.etree import ParserError
+
+# Body rows of the companies table on the top500 page
+TOP500_ROWS = '//div[contains(concat(" ", normalize-space(@class), " "), " col-lg-7 ")]//tbody[1]/tr'
+# Body rows of the quarterly table, the second one on a shares outstanding page
+SHARES_ROWS = '(//tbody)[2]/tr'
+# Column types of Yahoo Finance CSV with daily prices, volume is read as float to hold missing values
+PRICES_DTYPES = {'Date': str, 'Open': np.float64, 'High': np.float64, 'Low': np.float64, 'Close': np.float64,
+                 'Adj Close': np.float64, 'Volume': np.float64}
+
+
+def parse_top500(page: str) -> list[str]:
+    """Parse company codes from the top500 page"""
+    tree = lxml_html.fromstring(page)
+    return [''.join(row.findall('td')[2].itertext()).strip().upper() for row in tree.xpath(TOP500_ROWS)]
+
+
+def parse_shares(page: str) -> Optional[list[tuple[date, int]]]:
+    """Parse report dates and share counts from a company shares outstanding page, None if there is no table"""
+    try:
+        rows = lxml_html.fromstring(page).xpath(SHARES_ROWS)
+    except ParserError:  # Empty response
+        return None
+    if not rows:  # No table for a company on the site
+        return None
+    shares = []
+    for row in rows:
+        report_date, count = (''.join(col.itertext()) for col in row.findall('td')[:2])
+        try:  # Sometimes the table on the site have rows with no count for a date
+            count = int(count.replace(',', ''))
+        except ValueError:
+            continue
+        shares.append((date.fromisoformat(report_date.strip()), count))
+    return shares
+
+
+def clean_prices(prices: pd.DataFrame) -> pd.DataFrame:
+    """Clean daily prices read from a Yahoo Finance CSV with whole column operations
+
+    Duplicated dates are dropped and gaps up to 30 days are interpolated, prices are rounded to 4 digits.
+    """
+    prices = prices.set_index(pd.to_datetime(prices['Date'], format='%Y-%m-%d')).drop(columns='Date')
+    prices = prices[~prices.index.duplicated(keep='first')]
+    prices.columns = prices.columns.str.lower()
+    prices = prices.resample('D').interpolate(limit=30).dropna()
+    prices = prices.round(4)
+    prices['volume'] = prices['volume'].astype(np.int64)  # Interpolated volumes are truncated
+    return prices
+
+
+def parse_prices(csv_text: str) -> pd.DataFrame:
+    """Parse and clean a Yahoo Finance CSV with daily prices"""
+    return clean_prices(pd.read_csv(StringIO(csv_text), dtype=PRICES_DTYPES, na_values=['null']))
@@ -0,0 +1,94 @@
+import logging
+from datetime import date
+from typing import Iterable
+
+from django.core.management import CommandError
+from django.db import connection, transaction
+
+from markets.models import Model
+
+logger = logging.getLogger('django-sync')
+
+
+def partition_name(model: type[Model], year: int) -> str:
+    return f'{model._meta.db_table}_y{year}'
+
+
+def is_partitioned(model: type[Model]) -> bool:
+    """Check whether a price table is partitioned by date ranges (PostgreSQL only)"""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [model._meta.db_table])
+        return cursor.fetchone() is not None
+
+
+def partition_statements(model: type[Model], years: Iterable[int]) -> list[str]:
+    """Build statements creating missing yearly partitions of a table"""
+    qn = connection.ops.quote_name
+    return [f'CREATE TABLE IF NOT EXISTS {qn(partition_name(model, year))} PARTITION OF {qn(model._meta.db_table)} '
+            f'FOR VALUES FROM (\'{year}-01-01\') TO (\'{year + 1}-01-01\')' for year in years]
+
+
+def ensure_partitions(model: type[Model], years: Iterable[int]) -> None:
+    """Create yearly partitions for prices about to be loaded, if the table is partitioned"""
+    if not is_partitioned(model):
+        return
+    with connection.cursor() as cursor:
+        for statement in partition_statements(model, years):
+            cursor.execute(statement)
+
+
+def conversion_statements(model: type[Model], years: Iterable[int]) -> list[str]:
+    """Build statements converting a price table into one partitioned by year, keeping its data and schema
+
+    PostgreSQL requires unique constraints of a partitioned table to contain the partition key, so the
+    primary key becomes (id, date). Indexes are built after the data is copied.
+    """
+    qn = connection.ops.quote_name
+    meta = model._meta
+    table = meta.db_table
+    old = f'{table}_unpartitioned'
+    date_column = qn(meta.get_field('date').column)
+    statements = [
+        f'ALTER TABLE {qn(table)} RENAME TO {qn(old)}',
+        f'CREATE TABLE {qn(table)} (LIKE {qn(old)} INCLUDING DEFAULTS INCLUDING IDENTITY) '
+        f'PARTITION BY RANGE ({date_column})',
+        *partition_statements(model, years),
+        f'INSERT INTO {qn(table)} SELECT * FROM {qn(old)}',
+        f'SELECT setval(pg_get_serial_sequence(\'{table}\', \'{meta.pk.column}\'), '
+        f'COALESCE((SELECT MAX({qn(meta.pk.column)}) FROM {qn(table)}), 1))',
+        f'DROP TABLE {qn(old)}',
+        f'ALTER TABLE {qn(table)} ADD PRIMARY KEY ({qn(meta.pk.column)}, {date_column})',
+    ]
+    with connection.schema_editor(collect_sql=True) as editor:
+        statements.extend(str(constraint.create_sql(model, editor)) for constraint in meta.constraints)
+        statements.extend(str(index.create_sql(model, editor)) for index in meta.indexes)
+        for field in meta.concrete_fields:
+            if field.remote_field and field.db_constraint:
+                statements.append(str(editor._create_fk_sql(model, field, '_fk_%(to_table)s_%(to_column)s')))
+    return statements
+
+
+def partition_table(model: type[Model], dry_run: bool = False) -> list[str]:
+    """Convert a price table into one partitioned by year in a single transaction, return executed statements"""
+    if connection.vendor != 'postgresql':
+        raise CommandError('Partitioning is only supported on PostgreSQL')
+    if is_partitioned(model):
+        logger.info(f'Table {model._meta.db_table} is already partitioned')
+        return []
+    qn = connection.ops.quote_name
+    date_column = qn(model._meta.get_field('date').column)
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT EXTRACT(YEAR FROM MIN({date_column}))::int, EXTRACT(YEAR FROM MAX({date_column}))::int '
+                       f'FROM {qn(model._meta.db_table)}')
+        first, last = cursor.fetchone()
+    first, last = first or date.today().year, max(last or 0, date.today().year) + 1  # Next year is ready for syncs
+    statements = conversion_statements(model, range(first, last + 1))
+    if dry_run:
+        return statements
+    with transaction.atomic(), connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+    logger.info(f'Table {model._meta.db_table} was partitioned by year from {first} to {last}')
+    return statements
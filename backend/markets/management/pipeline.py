@@ -0,0 +1,103 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Callable, Optional
+
+from django.db import connections
+
+logger = logging.getLogger('django-sync')
+
+
+@dataclass
+class Stage:
+    """Sync stage, `run` returns the number of rows written"""
+    name: str
+    run: Callable[[], Optional[int]]
+    depends: tuple[str, ...] = ()
+
+
+@dataclass
+class StageResult:
+    """Outcome of a stage run, skipped stages are the ones with a failed or skipped dependency"""
+    name: str
+    duration: float = 0
+    rows: Optional[int] = None
+    error: Optional[str] = None
+    skipped: bool = False
+
+    def __str__(self) -> str:
+        if self.skipped:
+            return f'{self.name} - skipped, a dependency failed'
+        status = f'failed with {self.error}' if self.error else 'done'
+        rows = f', {self.rows} rows written' if self.rows is not None else ''
+        return f'{self.name} - {status} in {self.duration:.1f}s{rows}'
+
+
+class Pipeline:
+    """Run stages in order of their dependencies, independent ones in parallel threads"""
+
+    def __init__(self, stages: list[Stage]):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            unknown = set(stage.depends) - set(self.stages)
+            if unknown:
+                raise ValueError(f'Stage {stage.name} depends on unknown stages: {", ".join(sorted(unknown))}')
+        self.levels = self.plan()
+
+    def plan(self) -> list[list[str]]:
+        """Group stages in levels, stages of a level depend only on stages of previous levels"""
+        levels = []
+        done = set()
+        pending = list(self.stages)
+        while pending:
+            level = [name for name in pending if set(self.stages[name].depends) <= done]
+            if not level:
+                raise ValueError(f'Stages have circular dependencies: {", ".join(pending)}')
+            levels.append(level)
+            done.update(level)
+            pending = [name for name in pending if name not in done]
+        return levels
+
+    def describe(self) -> str:
+        """Describe the plan as numbered levels of stages with their dependencies"""
+        res = []
+        for index, level in enumerate(self.levels, start=1):
+            stages = ', '.join(f'{name} (after {", ".join(self.stages[name].depends)})'
+                               if self.stages[name].depends else name for name in level)
+            res.append(f'{index}. {stages}')
+        return '\n'.join(res)
+
+    @staticmethod
+    def run_stage(stage: Stage) -> StageResult:
+        start = perf_counter()
+        try:
+            rows = stage.run()
+        except Exception as error:  # Failure of a stage must not stop the independent ones
+            logger.exception(f'Sync stage {stage.name} failed')
+            return StageResult(stage.name, perf_counter() - start, error=repr(error))
+        finally:  # Connections are per thread, close the ones opened by the stage
+            connections.close_all()
+        return StageResult(stage.name, perf_counter() - start, rows)
+
+    def run(self, parallel: int = 1) -> list[StageResult]:
+        """Run stages with at most `parallel` of them at once, return results in plan order"""
+        order = [name for level in self.levels for name in level]
+        results = {}
+        running: dict[Future, str] = {}
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            while len(results) < len(order):
+                for name in order:  # Dependencies go first, so skipping cascades within a single pass
+                    if name in results or name in running.values():
+                        continue
+                    depends = [results.get(dep) for dep in self.stages[name].depends]
+                    if any(dep and (dep.error or dep.skipped) for dep in depends):
+                        results[name] = StageResult(name, skipped=True)
+                    elif all(depends):
+                        logger.info(f'Starting sync stage {name}')
+                        running[pool.submit(self.run_stage, self.stages[name])] = name
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results[running.pop(future)] = future.result()
+        return [results[name] for name in order]
@@ -0,0 +1,35 @@
+# Generated by Django 4.1.13 on 2026-10-18 03:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceChangeSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('date', models.DateField()),
+                ('current_price', models.FloatField()),
+                ('shares', models.FloatField(blank=True, null=True)),
+                ('change_day', models.FloatField(blank=True, null=True)),
+                ('change_week', models.FloatField(blank=True, null=True)),
+                ('change_month', models.FloatField(blank=True, null=True)),
+                ('change_quart', models.FloatField(blank=True, null=True)),
+                ('change_halfyear', models.FloatField(blank=True, null=True)),
+                ('change_year', models.FloatField(blank=True, null=True)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot', to='markets.company')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='pricechangesnapshot',
+            constraint=models.UniqueConstraint(fields=('company',), name='markets_pricechangesnapshot_company'),
+        ),
+    ]
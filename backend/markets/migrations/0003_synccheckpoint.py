@@ -0,0 +1,27 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0002_pricechangesnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=64)),
+                ('synced', models.DateTimeField()),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='markets.company')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='synccheckpoint',
+            constraint=models.UniqueConstraint(fields=('stage', 'company'), name='markets_synccheckpoint_stage_company'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0003_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockPriceCoverage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('since', models.DateField()),
+                ('to', models.DateField()),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_coverage', to='markets.company')),
+            ],
+            options={
+                'ordering': ['since'],
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='AssetPriceCoverage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('since', models.DateField()),
+                ('to', models.DateField()),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_coverage', to='markets.asset')),
+            ],
+            options={
+                'ordering': ['since'],
+                'abstract': False,
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='stockpricecoverage',
+            constraint=models.UniqueConstraint(fields=('company', 'since'), name='markets_stockpricecoverage_company_since'),
+        ),
+        migrations.AddConstraint(
+            model_name='assetpricecoverage',
+            constraint=models.UniqueConstraint(fields=('asset', 'since'), name='markets_assetpricecoverage_asset_since'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.1.13 on 2026-10-18 04:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0004_pricecoverage'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='share',
+            name='markets_sha_count_7ad487_idx',
+        ),
+        migrations.AddIndex(
+            model_name='yahooassetprice',
+            index=models.Index(fields=['asset', '-date'], include=('close',), name='yahooassetprice_ast_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='yahoostockprice',
+            index=models.Index(fields=['company', '-date'], include=('close',), name='yahoostockprice_cmp_date_idx'),
+        ),
+        migrations.AlterField(
+            model_name='yahooassetprice',
+            name='asset',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='markets.asset'),
+        ),
+        migrations.AlterField(
+            model_name='yahoostockprice',
+            name='company',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='markets.company'),
+        ),
+    ]
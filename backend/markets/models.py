@@ -123,6 +123,27 @@ class CompanyQuerySet(QuerySet):
         }
         return self.annotate(**changes_annotations)
 
+    def get_price_changes(self) -> dict[int, dict[str, float]]:
+        """Get current price and price changes per company, same values as `annotate_price_changes`
+
+        Closes a period ago are looked up by subqueries reading a single row at the period's offset in company's
+        prices, instead of a window over the whole price history of a company per period.
+        """
+        closes = YahooStockPrice.objects.filter(close__isnull=False, company=OuterRef('id')).order_by('-date')
+        offsets = {'current_price': 0, **self.changes}
+        closes_annotations = {
+            f'close_{field}': Subquery(closes.values('close')[offset:offset + 1]) for field, offset in offsets.items()
+        }
+        res = {}
+        for pk, current_price, *past_closes in self.annotate(**closes_annotations) \
+                .values_list('pk', *closes_annotations):
+            if current_price is None:
+                continue
+            res[pk] = {'current_price': current_price, **{
+                period: round(current_price / close, 4) for period, close in zip(self.changes, past_closes) if close
+            }}
+        return res
+
     def annotate_prices(self) -> CompanyQuerySet:
         """Annotate companies with current price and price's date"""
         base_price_qs = YahooStockPrice.objects.filter(close__isnull=False, company=OuterRef('id'))
@@ -196,17 +217,19 @@ class Price(Model):
         ordering = ['-date']
         indexes = [
             Index(fields=['date']),
-            Index(fields=['close']),
         ]
 
 
 class StockPrice(Price):
     """Abstract model for stock prices"""
-    company = ForeignKey(Company, on_delete=CASCADE)
+    company = ForeignKey(Company, on_delete=CASCADE, db_index=False)  # Covered by company and date index
 
     class Meta:
         abstract = True,
         ordering = ['-date', 'company']
+        indexes = [  # Most recent prices of a company, with close read from the index on PostgreSQL
+            Index(fields=['company', '-date'], include=['close'], name='%(class)s_cmp_date_idx'),
+        ]
         constraints = [
             UniqueConstraint(fields=['date', 'company'], name='%(app_label)s_%(class)s_date_company'),
         ]
@@ -214,11 +237,14 @@ class StockPrice(Price):
 
 class AssetPrice(Price):
     """Abstract model for asset prices"""
-    asset = ForeignKey(Asset, on_delete=CASCADE)
+    asset = ForeignKey(Asset, on_delete=CASCADE, db_index=False)  # Covered by asset and date index
 
     class Meta:
         abstract = True,
         ordering = ['-date', 'asset']
+        indexes = [  # Most recent prices of an asset, with close read from the index on PostgreSQL
+            Index(fields=['asset', '-date'], include=['close'], name='%(class)s_ast_date_idx'),
+        ]
         constraints = [
             UniqueConstraint(fields=['date', 'asset'], name='%(app_label)s_%(class)s_date_asset'),
         ]
@@ -258,13 +284,80 @@ class Share(Model):
         ordering = ['-date']
         indexes = [
             Index(fields=['date']),
-            Index(fields=['count']),
         ]
-        constraints = [
+        constraints = [  # Also serves lookups of the most recent share count of a company
             UniqueConstraint(fields=['company', 'date'], name='%(app_label)s_%(class)s_date_company'),
         ]
 
 
+class PriceChangeSnapshot(Model):
+    """Model for precomputed current price, share count and price changes per company, refreshed by syncs"""
+    modified = DateTimeField(auto_now=True)
+    company = ForeignKey(Company, on_delete=CASCADE, related_name='snapshot')
+    date = DateField()  # Date of the most recent price the changes are computed from
+    current_price = FloatField()
+    shares = FloatField(null=True, blank=True)
+    change_day = FloatField(null=True, blank=True)
+    change_week = FloatField(null=True, blank=True)
+    change_month = FloatField(null=True, blank=True)
+    change_quart = FloatField(null=True, blank=True)
+    change_halfyear = FloatField(null=True, blank=True)
+    change_year = FloatField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['company'], name='%(app_label)s_%(class)s_company'),
+        ]
+
+
+class SyncCheckpoint(Model):
+    """Model for companies already processed by a sync stage, so an interrupted sync resumes where it stopped"""
+    stage = CharField(max_length=64)
+    company = ForeignKey(Company, on_delete=CASCADE)
+    synced = DateTimeField()
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['stage', 'company'], name='%(app_label)s_%(class)s_stage_company'),
+        ]
+
+
+class SyncRun(Model):
+    """Model for completed syncs, the latest id versions cached reports across all server and sync processes"""
+    type = CharField(max_length=64)
+    finished = DateTimeField(auto_now_add=True)
+
+
+class PriceCoverage(Model):
+    """Abstract model for contiguous date ranges prices were fetched for, ranges of an item never overlap"""
+    since = DateField()
+    to = DateField()
+
+    class Meta:
+        abstract = True
+        ordering = ['since']
+
+
+class StockPriceCoverage(PriceCoverage):
+    """Model for date ranges stock prices of a company were fetched for"""
+    company = ForeignKey(Company, on_delete=CASCADE, related_name='price_coverage')
+
+    class Meta(PriceCoverage.Meta):
+        constraints = [
+            UniqueConstraint(fields=['company', 'since'], name='%(app_label)s_%(class)s_company_since'),
+        ]
+
+
+class AssetPriceCoverage(PriceCoverage):
+    """Model for date ranges prices of an asset were fetched for"""
+    asset = ForeignKey(Asset, on_delete=CASCADE, related_name='price_coverage')
+
+    class Meta(PriceCoverage.Meta):
+        constraints = [
+            UniqueConstraint(fields=['asset', 'since'], name='%(app_label)s_%(class)s_asset_since'),
+        ]
+
+
 class YahooStockPrice(StockPrice):
     """Model for Yahoo Finance stock prices"""
 
@@ -1,13 +1,97 @@
+import asyncio
 from datetime import timedelta, date
-from itertools import chain
+from functools import reduce
+from operator import or_
+from typing import Callable, Iterable
 
+import numpy
 import pandas
-
-from markets.models import YahooStockPrice, CompanyQuerySet, Share, Company, Asset, YahooAssetPrice
+from asgiref.sync import sync_to_async
+from django.db import connections
+from django.db.models import Case, Max, Q, Subquery, Value, When
+
+from markets.helpers import downsample_uniform, downsample_lttb
+from markets.models import YahooStockPrice, CompanyQuerySet, Share, Company, Asset, YahooAssetPrice, \
+    PriceChangeSnapshot, TreasuryRates
+from markets.store import get_price_store
+
+SECTOR_VALUE_FIELDS = [  # Sector market values a period ago, in order of `CompanyQuerySet.changes`
+    'sector_value_day_ago',
+    'sector_value_week_ago',
+    'sector_value_month_ago',
+    'sector_value_quart_ago',
+    'sector_value_halfyear_ago',
+    'sector_value_year_ago',
+]
+PRICE_CHANGES_COLUMNS = ['current_price', *CompanyQuerySet.changes, 'custom_price', 'change_custom']
+RATES_PER_DAY_OFFSETS = {  # Period: number of rows back from the most recent rates
+    'Yesterday': 0,
+    'Week': 5,
+    'Month': 20,
+    'Quarter': 60,
+    'Half Year': 120,
+    'Year': 250
+}
+DOWNSAMPLE_MODES = ['lttb', 'uniform']  # Rates downsampling preserving curves shape or evenly spaced in time
+
+
+def pack_closes(closes: numpy.ndarray) -> numpy.ndarray:
+    """Pack prices of a date x item matrix ordered from the most recent date to the top rows of every column"""
+    order = numpy.argsort(numpy.isnan(closes), axis=0, kind='stable')  # Available prices first, dates kept in order
+    return numpy.take_along_axis(closes, order, axis=0)
+
+
+def get_close_matrix(prices: pandas.DataFrame, item_field: str) -> tuple[pandas.Index, numpy.ndarray]:
+    """Pivot prices to a dense date x item close matrix with every item's prices packed to the top rows
+
+    Row N holds the Nth price counting back from an item's most recent one (NaN past its history), the same
+    value `iloc[N]` over an item's own rows gives, so every period offset becomes a single row lookup.
+    """
+    date_codes, dates = pandas.factorize(prices['date'], sort=True)
+    item_codes, items = pandas.factorize(prices[item_field], sort=True)
+    closes = numpy.full((len(dates), len(items)), numpy.nan)
+    closes[len(dates) - 1 - date_codes, item_codes] = prices['close'].to_numpy(dtype=float)  # The most recent first
+    return pandas.Index(items), pack_closes(closes)
+
+
+def _price_at(closes: numpy.ndarray, offset: int) -> numpy.ndarray:
+    """Get prices for all items `offset` rows back from the most recent, NaN if history is shorter"""
+    if offset >= len(closes):
+        return numpy.full(closes.shape[1], numpy.nan)
+    return closes[offset]
+
+
+def compute_price_changes(prices: pandas.DataFrame, item_field: str, custom_offset_since: int = 0,
+                          custom_offset_to: int = 0) -> pandas.DataFrame:
+    """Compute current price, price ratios for every period and a custom window for all items at once"""
+    if prices.empty:
+        return pandas.DataFrame(columns=PRICE_CHANGES_COLUMNS, dtype=float)
+    items, closes = get_close_matrix(prices, item_field)
+    return compute_matrix_changes(items, closes, custom_offset_since, custom_offset_to)
+
+
+def compute_matrix_changes(items: pandas.Index, closes: numpy.ndarray, custom_offset_since: int = 0,
+                           custom_offset_to: int = 0) -> pandas.DataFrame:
+    """Compute price changes of items from a close matrix packed by `get_close_matrix`"""
+    current = closes[0] if len(closes) else numpy.full(len(items), numpy.nan)
+    res = {'current_price': current}
+    for period_name, period in CompanyQuerySet.changes.items():
+        res[period_name] = numpy.round(current / _price_at(closes, period), 4)
+    custom_price = numpy.full(len(items), numpy.nan)
+    change_custom = numpy.full(len(items), numpy.nan)
+    if custom_offset_since:
+        if custom_offset_to:
+            custom_price = _price_at(closes, custom_offset_to)
+        change_custom = numpy.round(numpy.where(numpy.isnan(custom_price), current, custom_price)
+                                    / _price_at(closes, custom_offset_since), 4)
+    res['custom_price'] = custom_price
+    res['change_custom'] = change_custom
+    return pandas.DataFrame(res, index=items, columns=PRICE_CHANGES_COLUMNS)
 
 
 def get_price_changes_per_company(companies_qs: CompanyQuerySet, custom_since: date | None, custom_to: date | None):
-    most_recent_date = YahooStockPrice.objects.first().date
+    store = get_price_store()
+    most_recent_date = store.last_date if store else YahooStockPrice.objects.first().date
     since = most_recent_date - timedelta(days=365)  # Query prices for 400 days by default
     custom_offset_since = 0
     custom_offset_to = 0
@@ -16,136 +100,162 @@ def get_price_changes_per_company(companies_qs: CompanyQuerySet, custom_since: d
         custom_offset_since = max(0, (date.today() - custom_since).days)
         if custom_to:
             custom_offset_to = min(max(0, (date.today() - custom_to).days), custom_offset_since)
-    base_prices_qs = YahooStockPrice.objects.filter(date__gte=since - timedelta(days=5))
+    since = since - timedelta(days=5)
 
-    df = pandas.DataFrame(list(base_prices_qs.values('date', 'company', 'close')))
+    companies = pandas.DataFrame(list(companies_qs.values_list('pk', 'code', 'sector')),
+                                 columns=['pk', 'code', 'sector']).set_index('pk')
+    if store and store.covers(since):  # Closes are read from pages shared by workers instead of the database
+        items, closes = store.get_closes(companies.index.tolist(), since)
+        changes = compute_matrix_changes(items, pack_closes(closes), custom_offset_since, custom_offset_to)
+    else:
+        base_prices_qs = YahooStockPrice.objects.filter(date__gte=since, company__in=companies_qs.values('pk'))
+        df = pandas.DataFrame(list(base_prices_qs.values('date', 'company', 'close')),
+                              columns=['date', 'company', 'close'])
+        changes = compute_price_changes(df, 'company', custom_offset_since, custom_offset_to)
+    companies = companies.join(changes, how='inner')  # Companies with no available prices are left out
 
-    companies = list(companies_qs.values_list('pk', 'code', 'sector'))
-
-    res = dict()
-    for pk, code, sector in companies:
-        company_res = {'code': code, 'sector': sector}
-        company_df = df.loc[df['company'] == pk]
-        if company_df.empty:  # No available prices found for a company
-            continue
-        cur_price = company_df['close'].iloc[0]
-        company_res['current_price'] = cur_price
-        for period_name, period in companies_qs.changes.items():
-            if period > len(company_df.index):  # Period longer than available price history
-                continue
-            company_res[period_name] = round(cur_price / company_df['close'].iloc[period], 4)
-        if custom_offset_since and custom_offset_since <= len(company_df.index):
-            custom_price = cur_price
-            if custom_offset_to and custom_offset_to < len(company_df.index):
-                custom_price = company_df['close'].iloc[custom_offset_to]
-                company_res['custom_price'] = custom_price
-            company_res['change_custom'] = round(custom_price / company_df['close'].iloc[custom_offset_since], 4)
-        res[pk] = company_res
-    return res
+    return {pk: {key: value for key, value in company_res.items() if not pandas.isna(value)}
+            for pk, company_res in companies.to_dict('index').items()}
 
 
 def get_shares_per_company(company_perf: dict) -> None:
+    """Add the most recent share count reported within a year to companies"""
     since = date.today() - timedelta(days=366)
-    base_shares_qs = Share.objects.filter(date__gte=since)
-
-    df = pandas.DataFrame(list(base_shares_qs.values('company', 'count')))
-    for pk, company_res in company_perf.items():
-        company_df = df.loc[df['company'] == pk]
-        if company_df.empty:  # No available share count found for a company
-            continue
-        company_res['shares'] = company_df['count'].iloc[0]
-
-
-def get_sector_outstanding(sectors_perf: dict, companies_perf: dict) -> None:
-    companies_perf_list = companies_perf.values()
-
-    for sector, sector_perf in sectors_perf.items():
-        fields = CompanyQuerySet.changes
-        if 'sector_change_custom' in sector_perf:
-            fields = chain(fields, ['change_custom'])
-        for field in fields:
-            lst = list(sorted(filter(lambda x: x.get('sector') == sector and not x.get(field) is None,
-                                     companies_perf_list), key=lambda y: y.get(field), reverse=True))
-            bot = reversed(lst[-3:])
-            top = lst[:3]
+    store = get_price_store()
+    if store:
+        for pk, count in store.get_shares(list(company_perf), since).items():
+            company_perf[pk]['shares'] = count
+        return
+    base_shares_qs = Share.objects.filter(date__gte=since, company__in=list(company_perf)).order_by()
+
+    df = pandas.DataFrame(list(base_shares_qs.values_list('company', 'date', 'count')),
+                          columns=['company', 'date', 'count'])
+    # A single row per company with the latest date, companies with no share count found are left out
+    latest = df.sort_values('date').drop_duplicates('company', keep='last')
+    for pk, count in zip(latest['company'], latest['count']):
+        company_perf[pk]['shares'] = count
+
+
+def get_snapshot_changes_per_company(companies_qs: CompanyQuerySet) -> dict:
+    """Get precomputed prices, shares and price changes per company from snapshots"""
+    fields = ['current_price', 'shares', *CompanyQuerySet.changes]
+    snapshots = PriceChangeSnapshot.objects.filter(company__in=companies_qs).values(
+        'company', 'company__code', 'company__sector', *fields)
 
-            sector_perf[f'bot_{field}'] = list(map(lambda x: (x['code'], round((x[field] - 1) * 100, 1)), bot))
-            sector_perf[f'top_{field}'] = list(map(lambda x: (x['code'], round((x[field] - 1) * 100, 1)), top))
+    res = dict()
+    for snapshot in snapshots:
+        company_res = {'code': snapshot['company__code'], 'sector': snapshot['company__sector']}
+        company_res.update({field: snapshot[field] for field in fields if snapshot[field] is not None})
+        res[snapshot['company']] = company_res
+    return res
 
 
-def get_market_dynamics(custom_since=None, custom_to=None):
-    company_qs = Company.objects.last_top500()
-    companies_perf = get_price_changes_per_company(company_qs, custom_since, custom_to)
+def refresh_price_snapshots(companies_qs: CompanyQuerySet) -> int:
+    """Recompute and store price change snapshots for given companies"""
+    if not YahooStockPrice.objects.exists():
+        return 0
+    fields = ['current_price', 'shares', *CompanyQuerySet.changes]
+    companies_perf = get_price_changes_per_company(companies_qs, None, None)
     get_shares_per_company(companies_perf)
+    price_dates = dict(YahooStockPrice.objects.filter(company__in=list(companies_perf)).values('company')
+                       .annotate(last_date=Max('date')).values_list('company', 'last_date'))
+
+    res = PriceChangeSnapshot.objects.bulk_create(  # DB bulk upsert
+        [PriceChangeSnapshot(company_id=pk, date=price_dates[pk], **{field: perf.get(field) for field in fields})
+         for pk, perf in companies_perf.items()],
+        update_conflicts=True, unique_fields=['company'], update_fields=['modified', 'date', *fields]
+    )
+    return len(res)
+
+
+def get_sector_outstanding(sectors_perf: dict, companies_perf: dict, top: int = 3) -> None:
+    """Add `top` best and worst performing companies per sector for every price change to sectors"""
+    fields = list(CompanyQuerySet.changes)
+    if any('sector_change_custom' in sector_perf for sector_perf in sectors_perf.values()):
+        fields.append('change_custom')
+    sectors = list(sectors_perf)
+    sector_index = {sector: index for index, sector in enumerate(sectors)}
+    companies = [perf for perf in companies_perf.values() if perf.get('sector') in sector_index]
+    codes = [perf['code'] for perf in companies]
+    company_sectors = numpy.array([sector_index[perf['sector']] for perf in companies], dtype=numpy.int64)
+    changes = numpy.array([[perf.get(field) for field in fields] for perf in companies],
+                          dtype=numpy.float64).reshape(len(companies), len(fields))  # None becomes NaN
+
+    for column, field in enumerate(fields):
+        values = changes[:, column]
+        valid = numpy.flatnonzero(~numpy.isnan(values))
+        # Stable sort by sector, then by descending change, keeps the order of companies with equal changes
+        ranked = valid[numpy.lexsort((-values[valid], company_sectors[valid]))]
+        bounds = numpy.searchsorted(company_sectors[ranked], numpy.arange(len(sectors) + 1))
+        for index, sector in enumerate(sectors):
+            if field == 'change_custom' and 'sector_change_custom' not in sectors_perf[sector]:
+                continue
+            sector_ranked = ranked[bounds[index]:bounds[index + 1]]
+            for key, rows in [(f'top_{field}', sector_ranked[:top]), (f'bot_{field}', sector_ranked[::-1][:top])]:
+                sectors_perf[sector][key] = [(codes[row], round((float(values[row]) - 1) * 100, 1)) for row in rows]
+
+
+def compute_sector_changes(companies_perf: dict, custom_since=None, custom_to=None) -> dict[str, dict]:
+    """Compute market value of every sector today, for every period and a custom range ago and sector changes
+
+    Values of all companies are summed per sector in a single grouped sum over a company x value matrix, values
+    of companies with no share count or price and values for dates with no price change are left out.
+    """
+    fields = ['shares', 'current_price', 'custom_price', 'change_custom', *CompanyQuerySet.changes]
+    companies = list(companies_perf.values())
+    data = numpy.array([[perf.get(field) for field in fields] for perf in companies],
+                       dtype=numpy.float64).reshape(len(companies), len(fields))  # None becomes NaN
+    data[data == 0] = numpy.nan  # Zero counts, prices and changes are missing ones
+    shares, current_price, custom_price, change_custom = data[:, :4].T
+    changes = data[:, 4:]
+
+    value_today = shares * current_price
+    value_fields = ['sector_value_today']
+    values = [value_today]
+    if custom_since:
+        custom_value = shares * numpy.where(numpy.isnan(custom_price), current_price, custom_price)
+        value_fields.append('sector_value_custom')
+        values.append(custom_value / change_custom)
+        if custom_to:
+            value_fields.append('sector_value_custom_to')
+            values.append(numpy.where(numpy.isnan(change_custom), numpy.nan, custom_value))
+    value_fields.extend(SECTOR_VALUE_FIELDS)
+    values.extend((value_today[:, None] / changes).T)
 
-    sector_fields = [
-        'sector_value_day_ago',
-        'sector_value_week_ago',
-        'sector_value_month_ago',
-        'sector_value_quart_ago',
-        'sector_value_halfyear_ago',
-        'sector_value_year_ago',
-    ]
-
-    sector_changes = [
-        'sector_change_day', 'sector_change_week', 'sector_change_month',
-        'sector_change_quart', 'sector_change_halfyear', 'sector_change_year'
-    ]
+    sector_codes, sectors = pandas.factorize(numpy.array([perf['sector'] for perf in companies], dtype=object),
+                                             sort=True)
+    sectors_values = numpy.column_stack([  # Grouped sums, missing values are skipped
+        numpy.bincount(sector_codes, weights=numpy.nan_to_num(value), minlength=len(sectors)) for value in values
+    ]).round(4)
 
     sectors_perf = {}
-    sectors = set()
-
-    # Get all sectors
-    for company_id, perf in companies_perf.items():
-        sectors.add(perf['sector'])
-
-    # Preconfigure sector default values
-    for sector in sectors:
-        sectors_perf[sector] = {}
-        sectors_perf[sector]['sector_value_today'] = 0
-        if custom_since:
-            sectors_perf[sector]['sector_value_custom'] = 0
-            if custom_to:
-                sectors_perf[sector]['sector_value_custom_to'] = 0
-        for sector_field in sector_fields:
-            sectors_perf[sector][sector_field] = 0
-
-    # Calculate sector values (sums) for dates
-    for _, perf in companies_perf.items():
-        sector_perf = sectors_perf[perf['sector']]
-        shares = perf.get('shares')
-        cur_price = perf.get('current_price')
-        if not (shares and cur_price):  # No price or share count for company
-            continue
-        if perf.get('change_custom'):
-            custom_price = perf.get('custom_price') or cur_price
-            sector_perf['sector_value_custom'] += round(shares * custom_price / perf['change_custom'], 4)
-            if custom_to:
-                sector_perf['sector_value_custom_to'] += round(shares * custom_price, 4)
-        sector_perf['sector_value_today'] += round(shares * cur_price, 4)
-        for sector_field, change_field in zip(sector_fields, company_qs.changes):
-            if not perf.get(change_field):
-                continue
-            sector_perf[sector_field] += round(shares * cur_price / perf[change_field], 4)
-
-    # Calculate sector relative changes for periods
-    for sector, perf in sectors_perf.items():
-        if perf.get('sector_value_custom'):
-            if 'sector_value_custom_to' in perf:
-                perf['sector_change_custom'] = round(
-                    (perf['sector_value_custom_to'] / perf['sector_value_custom'] - 1) * 100, 1)
-            else:
-                perf['sector_change_custom'] = round(
-                    (perf['sector_value_today'] / perf['sector_value_custom'] - 1) * 100, 1)
-        else:
-            perf['sector_change_custom'] = None
-        for change_field, sector_field in zip(sector_changes, sector_fields):
-            if not perf[sector_field]:
-                perf[change_field] = None
-                continue
-            perf[change_field] = round((perf['sector_value_today'] / perf[sector_field] - 1) * 100, 1)
+    for sector, sector_values in zip(sectors, sectors_values.tolist()):
+        perf = dict(zip(value_fields, sector_values))
+        custom_value_to = perf.get('sector_value_custom_to', perf['sector_value_today'])
+        perf['sector_change_custom'] = (round((custom_value_to / perf['sector_value_custom'] - 1) * 100, 1)
+                                        if perf.get('sector_value_custom') else None)
+        for change_field, value_field in zip(CompanyQuerySet.sector_changes, SECTOR_VALUE_FIELDS):
+            perf[change_field] = (round((perf['sector_value_today'] / perf[value_field] - 1) * 100, 1)
+                                  if perf[value_field] else None)
+        sectors_perf[sector] = perf
+    return sectors_perf
 
-    get_sector_outstanding(sectors_perf, companies_perf)
+
+def get_market_dynamics(custom_since=None, custom_to=None, top: int = 3):
+    company_qs = Company.objects.last_top500()
+    if custom_since:
+        companies_perf = get_price_changes_per_company(company_qs, custom_since, custom_to)
+        get_shares_per_company(companies_perf)
+    else:  # Changes for default periods are precomputed by syncs
+        companies_perf = get_snapshot_changes_per_company(company_qs)
+        not_snapshot_qs = company_qs.exclude(pk__in=list(companies_perf))
+        if not_snapshot_qs.exists():  # Companies synced before snapshots appeared or new in top500
+            not_snapshot_perf = get_price_changes_per_company(not_snapshot_qs, None, None)
+            get_shares_per_company(not_snapshot_perf)
+            companies_perf.update(not_snapshot_perf)
+
+    sectors_perf = compute_sector_changes(companies_perf, custom_since, custom_to)
+    get_sector_outstanding(sectors_perf, companies_perf, top)
 
     sectors_perf = dict(sorted(sectors_perf.items(), key=lambda x: x[0]))
 
@@ -195,3 +305,88 @@ def get_assets_dynamics(custom_since=None, custom_to=None):
                 asset_res['change_custom'] = None
         res[name] = asset_res
     return res
+
+
+def downsample_rates(rates: list[dict], limit: int, mode: str = 'lttb') -> list[dict]:
+    """Reduce rates ordered by date to `limit` rows evenly spaced in time or with LTTB over average yield"""
+    if mode not in DOWNSAMPLE_MODES:
+        raise ValueError(f'Unknown downsampling mode: {mode}')
+    fields = [field for field in TreasuryRates.get_fields_list() if field != 'date']
+    if len(rates) <= limit:
+        return rates
+    yields = numpy.array([[rate.get(field) for field in fields] for rate in rates], dtype=float)
+    available = ~numpy.isnan(yields)
+    has_yields = available.any(axis=1)  # Days with no yields have nothing to plot
+    rates = [rate for rate, keep in zip(rates, has_yields) if keep]
+    yields, available = yields[has_yields], available[has_yields]
+    days = numpy.array([rate['date'].toordinal() for rate in rates], dtype=float)
+
+    if mode == 'uniform':
+        indexes = downsample_uniform(days, limit)
+    else:  # lttb
+        average = numpy.where(available, yields, 0).sum(axis=1) / available.sum(axis=1)
+        indexes = downsample_lttb(days, average, limit)
+    return [rates[index] for index in indexes]
+
+
+def get_sectors_report(custom_since=None, custom_to=None, top: int = 3) -> dict:
+    """Get assets, S&P 500 and market sectors dynamics with `top` outstanding companies per sector"""
+    assets = get_assets_dynamics(custom_since, custom_to)
+    sp500 = assets.pop('S&P 500')
+    return {'assets': assets, 'sp500': sp500, 'sectors': get_market_dynamics(custom_since, custom_to, top)}
+
+
+async def run_in_thread(func: Callable, *args):
+    """Run a sync function in a separate worker thread with its own DB connection, closed when done"""
+    def run():
+        try:
+            return func(*args)
+        finally:
+            connections.close_all()
+    return await sync_to_async(run, thread_sensitive=False)()
+
+
+async def aget_sectors_report(custom_since=None, custom_to=None, top: int = 3) -> dict:
+    """Get assets, S&P 500 and market sectors dynamics, independent reports are computed concurrently"""
+    assets, sectors = await asyncio.gather(run_in_thread(get_assets_dynamics, custom_since, custom_to),
+                                           run_in_thread(get_market_dynamics, custom_since, custom_to, top))
+    sp500 = assets.pop('S&P 500')
+    return {'assets': assets, 'sp500': sp500, 'sectors': sectors}
+
+
+def get_rates_per_day(when: date | Iterable[date] | None = None) -> list[dict]:
+    """Get yield curves for custom dates and the last day, week, month and so on ago
+
+    Rows at the periods' offsets from the most recent one are looked up by subqueries reading a single row, so
+    only the needed rows are fetched in a single query however long the rates history is.
+    """
+    fields = TreasuryRates.get_fields_list()
+    custom_dates = list(dict.fromkeys([when] if isinstance(when, date) else filter(None, when or [])))
+    latest_dates = TreasuryRates.objects.order_by('-date').values('date')
+    offset_dates = {offset: Subquery(latest_dates[offset:offset + 1]) for offset in RATES_PER_DAY_OFFSETS.values()}
+
+    rows = TreasuryRates.objects.filter(
+        reduce(or_, [Q(date=offset_date) for offset_date in offset_dates.values()], Q(date__in=custom_dates))
+    ).annotate(
+        offset=Case(*[When(date=offset_date, then=Value(offset)) for offset, offset_date in offset_dates.items()])
+    ).values(*fields, 'offset')
+    rates, rates_per_date = {}, {}
+    for row in rows:
+        offset = row.pop('offset')
+        if offset is not None:
+            rates[offset] = row
+        rates_per_date[row['date']] = row
+
+    full_res = []
+    for custom_date in custom_dates:
+        if custom_date in rates_per_date:
+            custom_res = TreasuryRates.serialize_per_day(dict(rates_per_date[custom_date]))
+            custom_res['label'] = custom_res['label'] + ' (Custom)'
+            full_res.append(custom_res)
+    for period, offset in RATES_PER_DAY_OFFSETS.items():
+        if offset not in rates:  # History is shorter
+            break
+        day_stat = TreasuryRates.serialize_per_day(dict(rates[offset]))
+        day_stat['label'] = day_stat['label'] + f' ({period})'
+        full_res.append(day_stat)
+    return full_res
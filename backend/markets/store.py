@@ -0,0 +1,152 @@
+import logging
+import os
+import shutil
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+import numpy
+import pandas
+from django.conf import settings
+
+from markets.models import Share, YahooStockPrice
+
+logger = logging.getLogger('django')
+
+# File with the name of the current store version, replaced atomically when a new version is written
+CURRENT_FILE = 'CURRENT'
+# Days of prices kept in the store, reports for older custom ranges read prices from the database
+HISTORY_DAYS = 365 * 5
+# Arrays of a store version, a file each
+STORE_ARRAYS = ['since', 'dates', 'companies', 'closes', 'shares', 'share_dates', 'last_share']
+# Versions kept on disk, the previous one may still be read by workers which have not swapped yet
+KEEP_VERSIONS = 2
+
+_store: Optional['PriceStore'] = None
+_store_lock = threading.Lock()
+
+
+@dataclass
+class PriceStore:
+    """Date x company close matrix and the latest share counts, read from memory-mapped files of a store version"""
+    directory: Path
+    version: str
+    since: numpy.ndarray  # Date prices are stored since, the history may start later
+    dates: numpy.ndarray  # Ascending dates as datetime64[D]
+    companies: numpy.ndarray  # Company pks of matrix columns, ascending
+    closes: numpy.ndarray  # NaN for dates with no price
+    shares: numpy.ndarray  # The latest share count per company, NaN if none
+    share_dates: numpy.ndarray  # Report date of the latest share count
+    last_share: numpy.ndarray  # Primary key of the latest stored share count, shares are only ever added
+
+    @classmethod
+    def load(cls, directory: Path, version: str) -> 'PriceStore':
+        path = directory / version
+        return cls(directory, version, **{name: numpy.load(path / f'{name}.npy', mmap_mode='r')
+                                          for name in STORE_ARRAYS})
+
+    @property
+    def last_date(self) -> Optional[date]:
+        return self.dates[-1].item() if len(self.dates) else None
+
+    def covers(self, since: date) -> bool:
+        """Check whether the store has all prices since a date"""
+        return self.since.item() <= since
+
+    def _columns(self, companies: list[int]) -> numpy.ndarray:
+        """Get matrix columns of companies which are in the store"""
+        if not len(self.companies):
+            return numpy.array([], dtype=numpy.int64)
+        companies = numpy.asarray(companies, dtype=numpy.int64)
+        columns = numpy.minimum(numpy.searchsorted(self.companies, companies), len(self.companies) - 1)
+        return columns[self.companies[columns] == companies]
+
+    def get_closes(self, companies: list[int], since: date) -> tuple[pandas.Index, numpy.ndarray]:
+        """Get date x company closes since a date, the most recent first, for companies with prices in the period"""
+        columns = self._columns(companies)
+        start = numpy.searchsorted(self.dates, numpy.datetime64(since, 'D'))
+        closes = self.closes[start:, columns][::-1]  # Fancy indexing copies only the selected columns
+        with_prices = ~numpy.isnan(closes).all(axis=0)  # Companies with no prices since the date are left out
+        return pandas.Index(self.companies[columns][with_prices]), closes[:, with_prices]
+
+    def get_shares(self, companies: list[int], since: date) -> dict[int, float]:
+        """Get the latest share count reported since a date per company, companies with no count are left out"""
+        columns = self._columns(companies)
+        recent = columns[self.share_dates[columns] >= numpy.datetime64(since, 'D')]  # NaT for no count is left out
+        return dict(zip(self.companies[recent].tolist(), self.shares[recent].tolist()))
+
+
+def _get_last_share() -> int:
+    return Share.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def write_price_store(directory: Path, history_days: int = HISTORY_DAYS) -> int:
+    """Write stock prices and share counts to a new store version and make it current, return number of prices"""
+    last_share = _get_last_share()  # Read first, counts added meanwhile only make the store stale
+    last_date = YahooStockPrice.objects.values_list('date', flat=True).first()
+    since = (last_date or date.today()) - timedelta(days=history_days)
+    prices = pandas.DataFrame(list(YahooStockPrice.objects.filter(date__gte=since).order_by()
+                                   .values_list('date', 'company', 'close')), columns=['date', 'company', 'close'])
+    shares = pandas.DataFrame(list(Share.objects.order_by().values_list('company', 'date', 'count')),
+                              columns=['company', 'date', 'count'])
+    shares = shares.sort_values('date').drop_duplicates('company', keep='last').set_index('company')
+
+    date_codes, dates = pandas.factorize(prices['date'], sort=True)
+    company_codes, companies = pandas.factorize(prices['company'], sort=True)
+    closes = numpy.full((len(dates), len(companies)), numpy.nan)
+    closes[date_codes, company_codes] = prices['close'].to_numpy(dtype=float)
+    shares = shares.reindex(companies)
+    arrays = {
+        'since': numpy.datetime64(since, 'D'),
+        'dates': numpy.asarray(dates, dtype='datetime64[D]'),
+        'companies': numpy.asarray(companies, dtype=numpy.int64),
+        'closes': closes,
+        'shares': shares['count'].to_numpy(dtype=float),
+        'share_dates': pandas.to_datetime(shares['date']).to_numpy(dtype='datetime64[D]'),
+        'last_share': numpy.int64(last_share),
+    }
+
+    directory.mkdir(parents=True, exist_ok=True)
+    version = f'{datetime.now():%Y%m%d%H%M%S%f}'
+    temp = directory / f'.{version}'
+    temp.mkdir()
+    for name, array in arrays.items():
+        numpy.save(temp / f'{name}.npy', array)
+    temp.rename(directory / version)
+    pointer = directory / f'.{CURRENT_FILE}.{os.getpid()}'
+    pointer.write_text(version)
+    pointer.replace(directory / CURRENT_FILE)  # Workers swap to the new version on their next read
+
+    versions = sorted(path for path in directory.iterdir() if path.is_dir() and not path.name.startswith('.'))
+    for path in versions[:-KEEP_VERSIONS]:  # Pages mapped by workers stay readable after files are removed
+        shutil.rmtree(path, ignore_errors=True)
+    logger.info(f'Price store version {version} written with {len(prices.index)} prices of '
+                f'{len(companies)} companies')
+    return len(prices.index)
+
+
+def get_price_store() -> Optional[PriceStore]:
+    """Get the current price store if it's enabled and holds the most recent prices, None otherwise"""
+    global _store
+    if not settings.PRICE_STORE_DIR:
+        return None
+    directory = Path(settings.PRICE_STORE_DIR)
+    try:
+        version = (directory / CURRENT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return None
+    with _store_lock:
+        if _store is None or _store.directory != directory or _store.version != version:
+            try:
+                _store = PriceStore.load(directory, version)
+            except FileNotFoundError:  # Written before an array was added, replaced by the next sync
+                return None
+        store = _store
+    # Prices and share counts synced after the store was written, e.g. by a sync with failed stages or by a shares
+    # sync, are read from the database
+    if store.last_date != YahooStockPrice.objects.values_list('date', flat=True).first() \
+            or store.last_share.item() != _get_last_share():
+        return None
+    return store
@@ -1,8 +1,24 @@
+import tempfile
 from datetime import date, timedelta
+from pathlib import Path
+from unittest.mock import patch
 
-from django.test import TestCase
+import numpy
+import pandas
 
-from markets.models import Top500, Company, YahooStockPrice, Share, CompanyQuerySet
+from django.db import connection
+from django.db.models import Max
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from markets.management.benchmarks import legacy_price_changes, legacy_sector_changes, legacy_sector_outstanding, \
+    synthetic_prices, synthetic_sectors_perf
+from markets.management.executor import SyncExecutor
+from markets.models import Top500, Company, YahooStockPrice, Share, CompanyQuerySet, PriceChangeSnapshot, Asset, \
+    YahooAssetPrice
+from markets.reports import get_price_changes_per_company, compute_price_changes, get_market_dynamics, \
+    refresh_price_snapshots, get_shares_per_company, get_sector_outstanding, compute_sector_changes
+from markets.store import get_price_store, write_price_store
 
 
 class TestReports(TestCase):
@@ -34,4 +50,190 @@ class TestReports(TestCase):
 
         _changes = company_qs.get_sector_changes()
         sectors = company_qs.get_sector_outstanding()
-        pass
+
+        # Correlated subqueries reading a single close at each period's offset (LIMIT 1 OFFSET n) give the same values
+        # as the per company annotations
+        changes = Company.objects.last_top500().get_price_changes()
+        for company in company_qs:
+            expected = {period: getattr(company, period) for period in company_qs.changes}
+            self.assertEqual(changes[company.pk], {'current_price': company.current_price, **expected})
+
+    def test_price_changes_per_company(self):
+        company_qs = Company.objects.last_top500()
+        custom_since = date.today() - timedelta(days=200)
+        custom_to = date.today() - timedelta(days=20)
+
+        res = get_price_changes_per_company(company_qs, custom_since, custom_to)
+
+        df = pandas.DataFrame(list(YahooStockPrice.objects.values('date', 'company', 'close')))
+        expected = legacy_price_changes(df, list(company_qs.values_list('pk', 'code', 'sector')), 200, 20)
+        self.assertEqual(res.keys(), expected.keys())
+        for pk, company_res in expected.items():
+            self.assertEqual(res[pk].keys(), company_res.keys())
+            self.assertEqual(res[pk]['code'], company_res.pop('code'))
+            self.assertEqual(res[pk]['sector'], company_res.pop('sector'))
+            for field, value in company_res.items():
+                self.assertAlmostEqual(res[pk][field], value, places=4)
+
+    def test_compute_price_changes_uneven_history(self):
+        df = synthetic_prices(items=3, days=100)
+        df = df.loc[~((df['company'] == 2) & (df['date'] > date.today() - timedelta(days=10)))]  # Stale company
+        df = df.loc[~((df['company'] == 3) & (df['date'] < date.today() - timedelta(days=5)))]  # Short history
+
+        changes = compute_price_changes(df, 'company', 50)
+        expected = legacy_price_changes(df, [(pk, pk, pk) for pk in range(1, 4)], 50)
+
+        for pk, company_res in expected.items():
+            for field in ['current_price', *CompanyQuerySet.changes, 'change_custom']:
+                if field in company_res:
+                    self.assertAlmostEqual(changes.loc[pk, field], company_res[field], places=4)
+                else:
+                    self.assertTrue(numpy.isnan(changes.loc[pk, field]))
+
+    def test_sector_outstanding(self):
+        company_qs = Company.objects.last_top500()
+        companies_perf = get_price_changes_per_company(company_qs, date.today() - timedelta(days=200), None)
+        companies_perf[company_qs.get(code='test2').pk]['change_week'] = None  # No price a week ago
+        companies_perf[company_qs.get(code='test4').pk]['change_month'] = \
+            companies_perf[company_qs.get(code='test5').pk]['change_month']  # Tie keeps the companies order
+
+        for top in [1, 3, 10]:
+            for custom in [{'sector_change_custom': 0}, {}]:
+                expected = {'sector1': dict(custom), 'sector2': {}, 'sector3': {}}
+                legacy_sector_outstanding(expected, companies_perf, top)
+                res = {'sector1': dict(custom), 'sector2': {}, 'sector3': {}}
+                get_sector_outstanding(res, companies_perf, top)
+                self.assertEqual(res, expected)
+
+        expected, companies_perf = synthetic_sectors_perf()
+        res = {sector: dict(perf) for sector, perf in expected.items()}
+        legacy_sector_outstanding(expected, companies_perf)
+        get_sector_outstanding(res, companies_perf)
+        self.assertEqual(res, expected)
+
+    def test_sector_changes(self):
+        company_qs = Company.objects.last_top500()
+        since, to = date.today() - timedelta(days=200), date.today() - timedelta(days=20)
+        cases = []
+        for custom_since, custom_to in [(None, None), (since, None), (since, to)]:
+            companies_perf = get_price_changes_per_company(company_qs, custom_since, custom_to)
+            get_shares_per_company(companies_perf)
+            cases.append((custom_since, custom_to, companies_perf))
+        cases.append((since, to, synthetic_sectors_perf()[1]))
+
+        for custom_since, custom_to, companies_perf in cases:
+            expected = legacy_sector_changes(companies_perf, custom_since, custom_to)
+            res = compute_sector_changes(companies_perf, custom_since, custom_to)
+            self.assertEqual(list(res), sorted(expected))
+            for sector, sector_res in expected.items():
+                self.assertEqual(res[sector].keys(), sector_res.keys())
+                for field, value in sector_res.items():
+                    if field.startswith('sector_value'):  # Sums are rounded once instead of every company's value
+                        self.assertAlmostEqual(res[sector][field], value, delta=len(companies_perf) * 1e-4)
+                    else:
+                        self.assertEqual(res[sector][field], value)
+
+    def test_shares_per_company_latest(self):
+        test1, test2, test3 = Company.objects.filter(code__in=['test1', 'test2', 'test3']).order_by('code')
+        today = date.today()
+        Share.objects.bulk_create([  # Older counts of test1 inserted after the latest one
+            Share(company=test1, date=today - timedelta(days=90), count=5),
+            Share(company=test1, date=today - timedelta(days=400), count=1),
+            Share(company=test2, date=today - timedelta(days=30), count=7),
+        ])
+        Share.objects.filter(company=test3).delete()
+
+        company_perf = {company.pk: {} for company in [test1, test2, test3]}
+        with self.assertNumQueries(1):
+            get_shares_per_company(company_perf)
+        self.assertEqual(company_perf, {test1.pk: {'shares': 10}, test2.pk: {'shares': 20}, test3.pk: {}})
+
+    def test_price_store(self):
+        since, to = date.today() - timedelta(days=200), date.today() - timedelta(days=20)
+        expected = [get_market_dynamics(since), get_market_dynamics(since, to)]
+        with tempfile.TemporaryDirectory() as directory, override_settings(PRICE_STORE_DIR=directory):
+            self.assertIsNone(get_price_store())
+            self.assertEqual(write_price_store(Path(directory)), YahooStockPrice.objects.count())
+            store = get_price_store()
+            with CaptureQueriesContext(connection) as queries:
+                res = [get_market_dynamics(since), get_market_dynamics(since, to)]
+            self.assertEqual(res, expected)
+            self.assertFalse([query for query in queries if 'yahoostockprice"."close' in query['sql']])
+            self.assertFalse([query for query in queries if 'markets_share"."count' in query['sql']])
+
+            # Share counts synced after the store was written are read from the database until a new version
+            test1 = Company.objects.get(code='test1')
+            Share.objects.create(company=test1, date=date.today() + timedelta(days=1), count=20)
+            self.assertIsNone(get_price_store())
+            refresh_price_snapshots(Company.objects.filter(pk=test1.pk))
+            self.assertEqual(PriceChangeSnapshot.objects.get(company=test1).shares, 20)
+            write_price_store(Path(directory))
+            self.assertEqual(get_price_store().get_shares([test1.pk], date.today()), {test1.pk: 20})
+
+            # Prices synced after the store was written are read from the database until a new version
+            company = Company.objects.get(code='test1')
+            YahooStockPrice.objects.create(company=company, date=date.today() + timedelta(days=1), open=1.0, high=1.0,
+                                           low=1.0, close=1.0, volume=100)
+            self.assertIsNone(get_price_store())
+            for _ in range(3):
+                write_price_store(Path(directory))
+            self.assertNotEqual(get_price_store().version, store.version)
+            self.assertEqual(len([path for path in Path(directory).iterdir() if path.is_dir()]), 2)
+
+            # Custom ranges older than the stored history are read from the database
+            self.assertFalse(get_price_store().covers(date.today() - timedelta(days=365 * 6)))
+
+    def test_snapshot_market_dynamics(self):
+        live = get_market_dynamics()  # No snapshots yet, computed from prices
+
+        self.assertEqual(refresh_price_snapshots(Company.objects.last_top500()), 6)
+        self.assertEqual(PriceChangeSnapshot.objects.filter(date=date.today()).count(), 6)
+        self.assertEqual(get_market_dynamics(), live)
+
+    def test_snapshots_stage(self):
+        companies = {company.code: company for company in Company.objects.all()}
+        refresh_price_snapshots(Company.objects.exclude(code='test6'))
+        for code, count in [('test1', 15), ('test2', 25)]:
+            Share.objects.create(company=companies[code], date=date.today() + timedelta(days=1), count=count)
+
+        # Within a pipeline only synced companies and the ones with no snapshot yet are refreshed
+        with patch.object(SyncExecutor, 'synced_companies', {companies['test1'].pk}):
+            self.assertEqual(SyncExecutor.sync_snapshots(), 2)
+        shares = dict(PriceChangeSnapshot.objects.values_list('company__code', 'shares'))
+        self.assertEqual([shares['test1'], shares['test2'], shares['test6']], [15, 20, 60])
+
+        self.assertEqual(SyncExecutor.sync_snapshots(), 6)  # Snapshots sync rebuilds all of them
+        self.assertEqual(PriceChangeSnapshot.objects.get(company=companies['test2']).shares, 25)
+
+
+class TestIndexes(TestCase):
+    """Hot lookups of recent prices and share counts of a company are served by indexes without sorting"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='test1', code='test1', sector='sector1')
+        cls.asset = Asset.objects.create(name='asset1', code='asset1')
+
+    def assertIndexScan(self, query):
+        if connection.vendor == 'postgresql':  # Tiny test tables are cheaper to scan sequentially
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = query.explain()
+            self.assertIn('Index', plan)
+            self.assertNotIn('Sort', plan)
+        else:
+            plan = query.explain()
+            self.assertRegex(plan, r'(SEARCH|SCAN) \S+ USING (COVERING )?INDEX')
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_prices_indexes(self):
+        companies = Company.objects.filter(pk=self.company.pk)
+        self.assertIndexScan(YahooStockPrice.objects.filter(company=self.company, close__isnull=False)
+                             .order_by('-date').values('close')[:1])
+        self.assertIndexScan(YahooStockPrice.objects.filter(company__in=companies.values('pk')).values('company')
+                             .annotate(last_date=Max('date')))
+        self.assertIndexScan(YahooAssetPrice.objects.filter(asset=self.asset).order_by('-date').values('close')[:1])
+
+    def test_shares_indexes(self):
+        self.assertIndexScan(Share.objects.filter(company=self.company, count__isnull=False)
+                             .order_by('-date').values('count')[:1])
@@ -0,0 +1,465 @@
+import tempfile
+import threading
+from io import StringIO
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import urlsplit
+
+import pandas as pd
+from django.core.management import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from markets.management.exports import export_tables, restore_tables
+from markets.management.executor import MarketSharesSyncer, TreasuryRatesSyncer, TreasuryRatesType, \
+    TreasuryParYieldAdapter, SyncExecutor
+from markets.management.benchmarks import legacy_parse_shares, legacy_parse_top500, legacy_clean_prices, \
+    synthetic_prices_csv, synthetic_shares_page, synthetic_top500_page
+from markets.management.fetcher import http_get
+from markets.management.loaders import bulk_load, copy_load
+from markets.management.parsers import parse_prices, parse_shares, parse_top500
+from markets.management.partitions import ensure_partitions, is_partitioned, partition_name, \
+    partition_statements, partition_table
+from markets.management.pipeline import Pipeline, Stage
+from markets.models import Company, YahooStockPrice, TreasuryRates, Top500, Share, SyncCheckpoint, StockPriceCoverage
+
+
+def prices_csv(days: int = 10) -> str:
+    """Build a Yahoo Finance like CSV with daily prices"""
+    rows = ['Date,Open,High,Low,Close,Adj Close,Volume']
+    for day in range(days, 0, -1):
+        rows.append(f'{date.today() - timedelta(days=day)},10.0,11.0,9.0,{10 + day / 10},{10 + day / 10},1000')
+    return '\n'.join(rows)
+
+
+class PricesHandler(BaseHTTPRequestHandler):
+    """Stand-in for Yahoo Finance, answers 404 for unknown codes"""
+    requested = []  # Paths of all requests
+
+    def do_GET(self):
+        self.requested.append(self.path)
+        code = urlsplit(self.path).path.strip('/')
+        if code == 'MISSING':
+            self.send_error(404)
+            return
+        body = prices_csv().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RatesHandler(BaseHTTPRequestHandler):
+    """Stand-in for US Treasury yearly archives, older years lack 1 and 2 months maturities"""
+
+    def do_GET(self):
+        year = int(urlsplit(self.path).path.strip('/'))
+        header = 'Date,1 Mo,2 Mo,3 Mo,6 Mo,1 Yr,2 Yr,3 Yr,5 Yr,7 Yr,10 Yr,20 Yr,30 Yr'
+        if year < 2000:
+            header = header.replace('1 Mo,2 Mo,', '')
+        rows = [header] + [f'{month:02}/15/{year},' + ','.join(['1.5'] * (header.count(',')))
+                           for month in range(1, 13)]
+        body = '\n'.join(rows).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SharesHandler(BaseHTTPRequestHandler):
+    """Stand-in for the shares outstanding site, redirects in a loop for a rate limited code"""
+
+    def do_GET(self):
+        code = urlsplit(self.path).path.strip('/')
+        if code == 'LIMIT':
+            self.send_response(302)
+            self.send_header('Location', self.path)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        rows = ''.join(f'<tr><td>{date.today() - timedelta(days=90 * quarter)}</td><td>1,000,00{quarter}</td></tr>'
+                       for quarter in range(1, 4))
+        body = f'<table><tbody></tbody></table><table><tbody>{rows}</tbody></table>'.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Answers 503 to the first request of every path and the number of requests to the path after"""
+    hits = {}
+
+    def do_GET(self):
+        self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        if self.hits[self.path] == 1:
+            self.send_error(503)
+            return
+        body = str(self.hits[self.path]).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServerTestCase(TestCase):
+    """Test case running a local HTTP server with given handler"""
+    handler = PricesHandler
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), cls.handler)
+        cls.server_url = f'http://127.0.0.1:{cls.server.server_port}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+
+class TestSyncPrices(LocalServerTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Company.objects.bulk_create([Company(name=f'test{i}', code=f'TEST{i}', sector='sector1') for i in range(12)])
+        Company.objects.create(name='missing', code='MISSING', sector='sector1')
+
+    def test_base_sync_prices_concurrently(self):
+        url = self.server_url + '/{}?period1={}&period2={}'
+        with patch.object(MarketSharesSyncer, 'prices_url', url):
+            synced, rows = MarketSharesSyncer.base_sync_prices(
+                Company.objects.all(), 'company', YahooStockPrice, workers=4, rate=100)
+
+        self.assertEqual(len(synced), 12)
+        self.assertEqual(rows, 12 * 10)
+        self.assertNotIn(Company.objects.get(code='MISSING').pk, synced)
+        self.assertEqual(YahooStockPrice.objects.count(), 12 * 10)
+        self.assertEqual(YahooStockPrice.objects.filter(company__code='TEST3').first().close, 10.1)
+
+    def test_base_sync_prices_last_dates_query_count(self):
+        YahooStockPrice.objects.bulk_create(
+            [YahooStockPrice(company=company, date=date.today() - timedelta(days=day), open=1.0, high=1.0, low=1.0,
+                             close=1.0, volume=100) for company in Company.objects.all() for day in range(2)]
+        )
+        # Count, items, coverage and a single query for the last price dates no matter how many items there are
+        with self.assertNumQueries(4):
+            synced, rows = MarketSharesSyncer.base_sync_prices(Company.objects.all(), 'company', YahooStockPrice)
+        self.assertEqual((synced, rows), ([], 0))
+
+    def period(self, day: date) -> str:
+        return str(int(datetime(*day.timetuple()[0:3]).timestamp()))
+
+    def test_base_sync_prices_fetches_missing_ranges(self):
+        company = Company.objects.get(code='TEST0')
+        today = date.today()
+        StockPriceCoverage.objects.bulk_create([
+            StockPriceCoverage(company=company, since=today - timedelta(days=365 * 25), to=today - timedelta(days=20)),
+            StockPriceCoverage(company=company, since=today - timedelta(days=10), to=today - timedelta(days=1)),
+        ])
+        PricesHandler.requested.clear()
+        with patch.object(MarketSharesSyncer, 'prices_url', self.server_url + '/{}?period1={}&period2={}'):
+            MarketSharesSyncer.base_sync_prices(Company.objects.filter(pk=company.pk), 'company', YahooStockPrice)
+
+        # The hole with 3 days of overlap, period2 is exclusive
+        self.assertEqual(PricesHandler.requested, [f'/TEST0?period1={self.period(today - timedelta(days=22))}'
+                                                   f'&period2={self.period(today - timedelta(days=10))}'])
+        self.assertEqual(list(company.price_coverage.values_list('since', 'to')),
+                         [(today - timedelta(days=365 * 25), today - timedelta(days=1))])
+
+    def test_repair_prices(self):
+        company = Company.objects.get(code='TEST1')
+        today = date.today()
+        YahooStockPrice.objects.bulk_create(
+            [YahooStockPrice(company=company, date=today - timedelta(days=day), open=1.0, high=1.0, low=1.0,
+                             close=1.0, volume=100) for day in [*range(1, 4), *range(40, 43)]]
+        )
+        PricesHandler.requested.clear()
+        with patch.object(MarketSharesSyncer, 'prices_url', self.server_url + '/{}?period1={}&period2={}'):
+            MarketSharesSyncer.repair_prices(Company.objects.filter(pk=company.pk), 'company', YahooStockPrice)
+
+        self.assertEqual(PricesHandler.requested, [f'/TEST1?period1={self.period(today - timedelta(days=42))}'
+                                                   f'&period2={self.period(today - timedelta(days=3))}'])
+        self.assertEqual(company.price_coverage.count(), 1)
+        self.assertTrue(YahooStockPrice.objects.filter(company=company, date=today - timedelta(days=5)).exists())
+
+    def test_bulk_load_conflicts(self):
+        company = Company.objects.get(code='TEST0')
+        frame = pd.DataFrame({'date': [date.today() - timedelta(days=day) for day in range(3)], 'open': 1.0,
+                              'high': 1.0, 'low': 1.0, 'close': [1.0, 2.0, 3.0], 'volume': 10,
+                              'company_id': company.pk})
+        bulk_load(YahooStockPrice, frame, unique_fields=['date', 'company'])
+
+        bulk_load(YahooStockPrice, frame.assign(close=5.0), unique_fields=['date', 'company'])
+        self.assertEqual(list(YahooStockPrice.objects.values_list('close', flat=True)), [1.0, 2.0, 3.0])
+
+        bulk_load(YahooStockPrice, frame.assign(close=5.0), unique_fields=['date', 'company'], update=True)
+        self.assertEqual(list(YahooStockPrice.objects.values_list('close', flat=True)), [5.0, 5.0, 5.0])
+
+    def test_copy_load(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('COPY is only supported on PostgreSQL')
+        company = Company.objects.get(code='TEST0')
+        frame = pd.DataFrame({'date': [date.today() - timedelta(days=day) for day in range(5)], 'open': 1.0,
+                              'high': 1.0, 'low': 1.0, 'close': [1.0, 2.0, 3.0, 4.0, 5.0], 'volume': 10,
+                              'company_id': company.pk})
+        staging = f'{YahooStockPrice._meta.db_table}_staging'
+        with connection.cursor() as cursor:  # A regular table named as the staging one is left alone
+            cursor.execute(f'CREATE TABLE {connection.ops.quote_name(staging)} (id int)')
+
+        self.assertEqual(copy_load(YahooStockPrice, frame, ['date', 'company'], chunk_size=2), 5)
+        self.assertEqual(copy_load(YahooStockPrice, frame.assign(close=9.0), ['date', 'company']), 0)
+        self.assertEqual(list(YahooStockPrice.objects.values_list('close', flat=True)), [1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(copy_load(YahooStockPrice, frame.assign(close=9.0), ['date', 'company'], update=True), 5)
+        self.assertEqual(set(YahooStockPrice.objects.values_list('close', flat=True)), {9.0})
+        self.assertFalse(YahooStockPrice.objects.filter(modified__isnull=True).exists())  # Filled in by SQL defaults
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT to_regclass(%s)', [f'public.{staging}'])
+            self.assertIsNotNone(cursor.fetchone()[0])
+
+
+class TestSyncRates(LocalServerTestCase):
+    handler = RatesHandler
+
+    def test_sync_archives(self):
+        with patch.object(TreasuryRatesSyncer, 'yearly_url', self.server_url + '/{}?type={}'):
+            TreasuryRatesSyncer.sync_archives(TreasuryRatesType.ParYieldCurve, [(1999, None), (2000, None)])
+
+        self.assertEqual(TreasuryRates.objects.count(), 24)
+        old_rate = TreasuryRates.objects.get(date=date(1999, 3, 15))
+        self.assertIsNone(old_rate.month1)
+        self.assertEqual(old_rate.year30, 1.5)
+        self.assertEqual(TreasuryRates.objects.get(date=date(2000, 3, 15)).month1, 1.5)
+
+    def test_adapter_upsert_counts(self):
+        rates = pd.DataFrame({'Date': ['01/03/2023', '01/04/2023'], '10 Yr': [3.5, 3.6]})
+        self.assertEqual(TreasuryParYieldAdapter.validate_and_store(rates), (2, 2))
+
+        rates['10 Yr'] = [3.7, 3.8]
+        self.assertEqual(TreasuryParYieldAdapter.validate_and_store(rates), (2, 0))
+        self.assertEqual(TreasuryRates.objects.get(date=date(2023, 1, 4)).year10, 3.8)
+
+
+class TestSyncShares(LocalServerTestCase):
+    handler = SharesHandler
+
+    @classmethod
+    def setUpTestData(cls):
+        companies = Company.objects.bulk_create(
+            [Company(name=f'test{i}', code=f'TEST{i}', sector='sector1') for i in range(5)])
+        companies.append(Company.objects.create(name='limit', code='LIMIT', sector='sector1'))
+        Top500.objects.bulk_create([Top500(company=company, date=date.today()) for company in companies])
+
+    def test_sync_shares_count_resumes(self):
+        with patch.object(MarketSharesSyncer, 'shares_url', self.server_url + '/{}'), \
+                patch.object(MarketSharesSyncer, 'shares_chunk_size', 2):
+            MarketSharesSyncer.sync_shares_count(workers=1, rate=100)
+            self.assertEqual(Share.objects.filter(company__code='TEST0').count(), 3)
+            self.assertEqual(Share.objects.get(company__code='TEST0', date=date.today() - timedelta(days=90)).count,
+                             1_000_001)
+            self.assertFalse(SyncCheckpoint.objects.filter(company__code='LIMIT').exists())
+
+            # Processed companies are skipped by the next run, the limited one is tried again
+            Share.objects.all().delete()
+            Company.objects.filter(code='LIMIT').update(code='TEST5')
+            MarketSharesSyncer.sync_shares_count(workers=1, rate=100)
+        self.assertEqual(set(Share.objects.values_list('company__code', flat=True)), {'TEST5'})
+        self.assertEqual(SyncCheckpoint.objects.count(), 6)
+
+
+class TestHttpClient(LocalServerTestCase):
+    handler = FlakyHandler
+
+    def test_retry_and_cache(self):
+        host = self.server_url.split('//')[1]
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(HTTP_CACHE_DIR=cache_dir), \
+                patch.dict('markets.management.fetcher.cache_ttl', {host: 60}):
+            self.assertEqual(http_get(self.server_url + '/cached'), '2')  # Retried after 503
+            self.assertEqual(http_get(self.server_url + '/cached'), '2')  # Served from disk
+            with patch.dict('markets.management.fetcher.cache_ttl', {host: 0}):
+                self.assertEqual(http_get(self.server_url + '/cached'), '3')  # No caching for the source
+        self.assertEqual(http_get(self.server_url + '/uncached'), '2')  # Cache disabled
+        self.assertEqual(http_get(self.server_url + '/uncached'), '3')
+
+
+class TestParsers(SimpleTestCase):
+    def test_parse_top500(self):
+        page = synthetic_top500_page()
+        codes = parse_top500(page)
+        self.assertEqual(len(codes), 503)
+        self.assertEqual(codes[2], 'BRK.B')
+        self.assertEqual(codes, legacy_parse_top500(page))
+
+    def test_parse_shares(self):
+        page = synthetic_shares_page()
+        shares = parse_shares(page)
+        self.assertEqual(len(shares), 55)  # A row with no count is skipped
+        self.assertEqual(shares[0][0], date(2022, 12, 31))
+        self.assertEqual(shares, [(date.fromisoformat(day), int(count.replace(',', '')))
+                                  for day, count in legacy_parse_shares(page) if count])
+        self.assertIsNone(parse_shares('<html><body><p>Not found</p></body></html>'))
+        for page in ['', '  \n']:  # Blank responses are no table too
+            self.assertIsNone(parse_shares(page))
+
+    def test_parse_prices(self):
+        prices = parse_prices('Date,Open,High,Low,Close,Adj Close,Volume\n'
+                              '2023-01-02,1.0,1.0,1.0,1.00001,1.0,100\n'
+                              '2023-01-02,2.0,2.0,2.0,2.0,2.0,200\n'
+                              '2023-01-03,null,null,null,null,null,null\n'
+                              '2023-01-05,3.0,3.0,3.0,3.0,3.0,301\n')
+        self.assertEqual(list(prices.index.date), [date(2023, 1, day) for day in range(2, 6)])
+        self.assertEqual(list(prices['close']), [1.0, 1.6667, 2.3333, 3.0])  # Duplicate dropped, gaps interpolated
+        self.assertEqual(list(prices['volume']), [100, 167, 234, 301])
+
+    def test_parse_prices_same_as_legacy(self):
+        csv_text = synthetic_prices_csv(365)
+        pd.testing.assert_frame_equal(parse_prices(csv_text), legacy_clean_prices(pd.read_csv(StringIO(csv_text))),
+                                      check_freq=False)
+
+
+class TestPipeline(SimpleTestCase):
+    def test_independent_stages_run_in_parallel(self):
+        barrier = threading.Barrier(2, timeout=5)  # Breaks unless both stages run at once
+        finished = []
+
+        def stage(name: str, rows: int):
+            def run():
+                if name in ['rates', 'prices']:
+                    barrier.wait()
+                finished.append(name)
+                return rows
+            return run
+
+        pipeline = Pipeline([Stage('rates', stage('rates', 10)), Stage('prices', stage('prices', 20)),
+                             Stage('snapshots', stage('snapshots', 5), depends=('prices',))])
+        self.assertEqual(pipeline.levels, [['rates', 'prices'], ['snapshots']])
+        results = pipeline.run(parallel=2)
+
+        self.assertEqual(finished[-1], 'snapshots')
+        self.assertEqual([(res.name, res.rows, res.error) for res in results],
+                         [('rates', 10, None), ('prices', 20, None), ('snapshots', 5, None)])
+
+    def test_failed_stage_skips_dependents(self):
+        def fail():
+            raise ValueError('broken')
+
+        pipeline = Pipeline([Stage('top500', fail), Stage('shares', lambda: 1, depends=('top500',)),
+                             Stage('snapshots', lambda: 1, depends=('shares',)), Stage('rates', lambda: 3)])
+        with self.assertLogs('django-sync', 'ERROR'):
+            results = {res.name: res for res in pipeline.run()}
+
+        self.assertIn('broken', results['top500'].error)
+        self.assertTrue(results['shares'].skipped and results['snapshots'].skipped)
+        self.assertEqual(results['rates'].rows, 3)
+
+    def test_plan(self):
+        with self.assertRaises(ValueError):
+            Pipeline([Stage('a', lambda: 0, depends=('b',)), Stage('b', lambda: 0, depends=('a',))])
+        self.assertEqual(SyncExecutor.pipeline('daily').levels,
+                         [['currentrates', 'top500', 'assetprices'], ['marketshares', 'stockprices'],
+                          ['pricestore'], ['snapshots']])
+
+
+class TestPartitions(TestCase):
+    def test_partition_statements(self):
+        statements = partition_statements(YahooStockPrice, range(2022, 2024))
+        self.assertEqual(len(statements), 2)
+        self.assertIn('markets_yahoostockprice_y2023', statements[1])
+        self.assertIn("FROM ('2023-01-01') TO ('2024-01-01')", statements[1])
+
+    def test_not_partitioned_database(self):
+        if connection.vendor == 'postgresql':
+            self.skipTest('Partitioning is supported')
+        with self.assertNumQueries(0):
+            ensure_partitions(YahooStockPrice, [2023])
+        with self.assertRaises(CommandError):
+            partition_table(YahooStockPrice)
+
+    def test_partition_table(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('Partitioning is only supported on PostgreSQL')
+        company = Company.objects.create(name='Test', code='TEST', sector='Tech')
+        YahooStockPrice.objects.bulk_create(
+            [YahooStockPrice(company=company, date=date(2021, 12, 1) + timedelta(days=day), open=1.0, high=1.0,
+                             low=1.0, close=day, volume=100) for day in range(60)])
+        prices = list(YahooStockPrice.objects.order_by('pk').values_list('id', 'company', 'date', 'close'))
+
+        self.assertTrue(partition_table(YahooStockPrice, dry_run=True))
+        self.assertFalse(is_partitioned(YahooStockPrice))
+        with connection.cursor() as cursor:  # Deferred foreign key checks of the test transaction block ALTER TABLE
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        partition_table(YahooStockPrice)  # DDL is rolled back with the test transaction
+        self.assertTrue(is_partitioned(YahooStockPrice))
+        self.assertEqual(partition_table(YahooStockPrice), [])
+        self.assertEqual(list(YahooStockPrice.objects.order_by('pk').values_list('id', 'company', 'date', 'close')),
+                         prices)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass',
+                           [YahooStockPrice._meta.db_table])
+            partitions = {name for name, in cursor.fetchall()}
+        self.assertEqual(partitions, {partition_name(YahooStockPrice, year)
+                                      for year in range(2021, date.today().year + 2)})
+
+        # Syncs create partitions for prices of years with none and keep ids and unique constraints
+        year = date.today().year + 2
+        ensure_partitions(YahooStockPrice, [year])
+        price = YahooStockPrice.objects.create(company=company, date=date(year, 1, 1), open=1.0, high=1.0, low=1.0,
+                                               close=1.0, volume=100)
+        self.assertGreater(price.pk, prices[-1][0])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            YahooStockPrice.objects.create(company=company, date=date(year, 1, 1), open=1.0, high=1.0, low=1.0,
+                                           close=1.0, volume=100)
+
+
+class TestExports(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        company = Company.objects.create(name='Test', code='TEST', sector='Tech')
+        Share.objects.create(company=company, date=date(2023, 3, 31), count=1000)
+        TreasuryRates.objects.create(date=date(2023, 1, 3), month1=4.2, year30=None)
+        YahooStockPrice.objects.bulk_create(
+            [YahooStockPrice(company=company, date=date(2022, 12, 25) + timedelta(days=day), open=1.0, high=1.0,
+                             low=1.0, close=day, volume=10 ** 10) for day in range(20)])
+
+    def test_export_restore(self):
+        tables = {model: list(model.objects.order_by('pk').values()) for model in [Company, Share, TreasuryRates]}
+        prices = list(YahooStockPrice.objects.order_by('pk').values_list('id', 'company', 'date', 'close', 'volume'))
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            self.assertEqual(export_tables(directory, chunk_size=8)['stockprices'], 20)
+            self.assertEqual(sorted(path.parent.name for path in (directory / 'stockprices').rglob('*.parquet')),
+                             ['year=2022', 'year=2023', 'year=2023', 'year=2023'])  # Chunks split by year
+            with self.assertRaises(CommandError):  # Export never mixes with older files
+                export_tables(directory)
+
+            Company.objects.all().delete()
+            TreasuryRates.objects.all().delete()
+            restored = restore_tables(directory, chunk_size=8)
+            self.assertEqual(restored['stockprices'], 20)
+            for model, rows in tables.items():
+                self.assertEqual(list(model.objects.order_by('pk').values()), rows)
+            self.assertEqual(list(YahooStockPrice.objects.order_by('pk').values_list(
+                'id', 'company', 'date', 'close', 'volume')), prices)
+
+            restore_tables(directory, ['companies', 'shares'])  # Stored rows are skipped
+            self.assertEqual(Share.objects.count(), 1)
+            Company.objects.create(name='New', code='NEW', sector='Tech')  # Ids continue after restored ones
+
+        with tempfile.TemporaryDirectory() as directory, self.assertRaises(CommandError):
+            restore_tables(Path(directory))
@@ -0,0 +1,186 @@
+from datetime import date, timedelta
+from unittest.mock import patch
+
+import orjson
+
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from config.asgi import app
+from markets.api import RatesAPIView
+from markets.cache import get_cache_stats, invalidate_reports, is_shared_cache
+from markets.management.benchmarks import synthetic_rates, load_test, legacy_rates_per_day
+from markets.models import Top500, Company, YahooStockPrice, Share, Asset, YahooAssetPrice, TreasuryRates, SyncRun
+from markets.reports import get_rates_per_day
+
+
+async def asgi_get(path: str, query_string: bytes = b'') -> list[dict]:
+    """Send a GET request to the ASGI application, return messages it sent back"""
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string, 'root_path': '',
+             'headers': [(b'host', b'testserver')], 'http_version': '1.1', 'scheme': 'http',
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 0)}
+    messages = []
+
+    async def receive() -> dict:
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message: dict) -> None:
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages
+
+
+class TestSectorsView(TransactionTestCase):
+    """Reports are computed in separate threads, so test data must be committed"""
+
+    def setUp(self):
+        cache.clear()
+        today = date.today()
+        for i in range(1, 4):
+            company = Company.objects.create(name=f'test{i}', code=f'test{i}', sector=f'sector{i % 2}')
+            Top500.objects.create(company=company, date=today)
+            Share.objects.create(company=company, date=today, count=10 * i)
+            YahooStockPrice.objects.bulk_create(
+                [YahooStockPrice(company=company, date=today - timedelta(days=day), open=1.0, high=1.0, low=1.0,
+                                 close=round(30 * (1 - i / 1000) ** day, 6), volume=100) for day in range(400)]
+            )
+        asset = Asset.objects.create(name='S&P 500', code='^GSPC')
+        YahooAssetPrice.objects.bulk_create(
+            [YahooAssetPrice(asset=asset, date=today - timedelta(days=day), open=1.0, high=1.0, low=1.0,
+                             close=4000 - day, volume=100) for day in range(400)]
+        )
+
+    def test_sectors_cache(self):
+        response = self.client.get(reverse('sectors'))
+        self.assertEqual(response['X-Cache'], 'MISS')
+        response = self.client.get(reverse('sectors'))
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response.context['sp500']['change_day'], 0.0)
+
+        # Same custom range in different formats shares a cache entry
+        self.assertEqual(self.client.get(reverse('sectors'), {'since': '01/01/2023'})['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get(reverse('sectors'), {'since': '1/1/23'})['X-Cache'], 'HIT')
+
+        invalidate_reports()
+        self.assertEqual(self.client.get(reverse('sectors'))['X-Cache'], 'MISS')
+        self.assertEqual(get_cache_stats(), {'hits': 2, 'misses': 3})
+
+        # A sync in another process shares only the database with the server
+        self.assertEqual(self.client.get(reverse('sectors'))['X-Cache'], 'HIT')
+        SyncRun.objects.create(type='daily')
+        self.assertEqual(self.client.get(reverse('sectors'))['X-Cache'], 'MISS')
+
+    def test_shared_cache(self):
+        self.assertFalse(is_shared_cache())  # Local memory by default
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                                   'LOCATION': '/var/tmp/canary-test'}}):
+            self.assertTrue(is_shared_cache())
+
+    async def test_concurrent_requests(self):
+        paths = [f'/sectors?since={(date.today() - timedelta(days=30 + i)).strftime("%d/%m/%Y")}' for i in range(5)]
+        latencies, _ = await load_test(paths + ['/yield-per-day', '/yield-per-maturity'], concurrency=4)
+        self.assertEqual(len(latencies), 7)
+        self.assertEqual(get_cache_stats(), {'hits': 0, 'misses': 5})
+
+    def test_dynamics_api(self):
+        response = self.client.get(reverse('api_sectors'), {'since': '01/01/2023'})
+        sectors = orjson.loads(response.content)
+        self.assertEqual(set(sectors), {'sector0', 'sector1'})
+        self.assertEqual(len(sectors['sector1']['top_change_day']), 2)
+
+        # Malformed and out of range numbers of outstanding companies fall back to the default or the bounds
+        for top, expected in [('abc', 3), ('-1', 1), ('0', 1), ('1000', 20)]:
+            sectors = orjson.loads(self.client.get(reverse('api_sectors'), {'top': top}).content)
+            self.assertEqual(len(sectors['sector1']['top_change_day']), min(expected, 2))
+            self.assertEqual(self.client.get(reverse('sectors'), {'top': top}).status_code, 200)
+        self.assertEqual(self.client.get(reverse('api_sectors'), {'top': '1'}).content,
+                         self.client.get(reverse('api_sectors'), {'top': '-1'}).content)
+
+        response = self.client.get(reverse('api_assets'))
+        self.assertEqual(orjson.loads(response.content)['S&P 500']['current_price'], 4000)
+        last_modified = response['Last-Modified']
+        response = self.client.get(reverse('api_assets'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get(reverse('api_assets'), HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        SyncRun.objects.create(type='marketshares')  # Share counts change with no new price date
+        self.assertEqual(self.client.get(reverse('api_assets'), HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+
+class TestYieldPerMaturityView(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        TreasuryRates.objects.bulk_create([TreasuryRates(**rate) for rate in synthetic_rates(date(2015, 1, 1))])
+        TreasuryRates.objects.filter(date__year=2018).delete()  # Gap in ids and dates
+
+    def test_downsampling(self):
+        rates = list(TreasuryRates.objects.order_by('date').values_list('date', flat=True))
+        for mode in ['lttb', 'uniform']:
+            response = self.client.get(reverse('yield_per_maturity'),
+                                       {'since': '01/01/2015', 'limit': 40, 'mode': mode})
+            labels = response.context['rates']['labels']
+            self.assertLessEqual(len(labels), 40)
+            self.assertGreater(len(labels), 30)
+            self.assertEqual(labels, sorted(labels))
+            self.assertEqual((labels[0], labels[-1]), (rates[0], rates[-1]))
+            self.assertEqual(len(response.context['rates']['datasets'][0]['data']), len(labels))
+
+        response = self.client.get(reverse('yield_per_maturity'), {'since': '01/01/2015', 'limit': 10000})
+        self.assertEqual(response.context['rates']['labels'], rates)
+        for params in [{'limit': 'abc'}, {'limit': '0'}, {'mode': 'cubic'}]:
+            self.assertEqual(self.client.get(reverse('yield_per_maturity'), params).status_code, 400)
+
+    def test_rates_api(self):
+        with patch.object(RatesAPIView, 'chunk_size', 100):
+            response = self.client.get(reverse('api_rates'), {'since': '01/01/2015'})
+            rates = orjson.loads(b''.join(response.streaming_content))
+            empty = self.client.get(reverse('api_rates'), {'since': '01/01/2100'})
+            self.assertEqual(b''.join(empty.streaming_content), b'[]')
+        dates = TreasuryRates.objects.order_by('date').values_list('date', flat=True)
+        self.assertEqual([rate['date'] for rate in rates], [day.isoformat() for day in dates])
+
+        response = self.client.get(reverse('api_rates'), {'since': '01/01/2015', 'limit': 40})
+        self.assertLessEqual(len(orjson.loads(response.content)), 40)
+        for limit in ['abc', '0', '-5']:
+            self.assertEqual(self.client.get(reverse('api_rates'), {'limit': limit}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_rates'), {'limit': 40, 'mode': 'cubic'}).status_code, 400)
+
+        etag = response['ETag']
+        self.assertEqual(self.client.get(reverse('api_rates'), {'since': '01/01/2015', 'limit': 40},
+                                         HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(reverse('api_rates'), {'limit': 40}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get(reverse('api_rates'), HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+                         .status_code, 304)
+
+        per_day = orjson.loads(self.client.get(reverse('api_rates_per_day')).content)
+        self.assertEqual(len(per_day), 6)
+        self.assertTrue(per_day[-1]['label'].endswith('(Year)'))
+
+    async def test_rates_api_asgi(self):
+        """Whole responses go through the ASGI handler as the server runs them, not only the view"""
+        for query_string in [b'', b'limit=40']:
+            with patch.object(RatesAPIView, 'chunk_size', 100):
+                messages = await asgi_get(reverse('api_rates'), query_string)
+            self.assertEqual(messages[0]['status'], 200)
+            rates = orjson.loads(b''.join(message.get('body', b'') for message in messages[1:]))
+            self.assertEqual(len(rates), 40 if query_string else await TreasuryRates.objects.acount())
+            if not query_string:  # Streamed in chunks
+                self.assertGreater(len(messages), len(rates) // 100)
+
+    def test_rates_per_day(self):
+        dates = list(TreasuryRates.objects.order_by('-date').values_list('date', flat=True))
+        for when in [None, dates[5], dates[-1], date(2018, 6, 1)]:  # Period's date, the oldest one and a missing one
+            with self.assertNumQueries(1):
+                res = get_rates_per_day(when)
+            self.assertEqual(res, legacy_rates_per_day(when))
+
+        response = self.client.get(reverse('yield_per_day'), {'when': [dates[-1].strftime('%d/%m/%Y'),
+                                                                      dates[100].strftime('%d/%m/%Y'), '']})
+        labels = [day['label'] for day in response.context['rates']['datasets']]
+        self.assertEqual(labels[:2], [f'{dates[-1]:%d/%m/%y} (Custom)', f'{dates[100]:%d/%m/%y} (Custom)'])
+        self.assertEqual(len(labels), 8)
+
+        TreasuryRates.objects.filter(date__lt=dates[10]).delete()  # History shorter than a month
+        self.assertEqual([day['label'] for day in get_rates_per_day()],
+                         [f'{dates[0]:%d/%m/%y} (Yesterday)', f'{dates[5]:%d/%m/%y} (Week)'])
@@ -1,5 +1,6 @@
 from django.urls import path
 
+from .api import RatesAPIView, RatesPerDayAPIView, DynamicsAPIView
 from .views import IndexView, YieldPerDayView, YieldPerMaturityView, SectorsView
 
 urlpatterns = [
@@ -7,4 +8,8 @@ urlpatterns = [
     path('yield-per-day', YieldPerDayView.as_view(), name='yield_per_day'),
     path('yield-per-maturity', YieldPerMaturityView.as_view(), name='yield_per_maturity'),
     path('sectors', SectorsView.as_view(), name='sectors'),
+    path('api/v1/rates', RatesAPIView.as_view(), name='api_rates'),
+    path('api/v1/rates/per-day', RatesPerDayAPIView.as_view(), name='api_rates_per_day'),
+    path('api/v1/assets', DynamicsAPIView.as_view(report='assets'), name='api_assets'),
+    path('api/v1/sectors', DynamicsAPIView.as_view(report='sectors'), name='api_sectors'),
 ]
@@ -1,10 +1,12 @@
-from django.db.models import F
+from asgiref.sync import sync_to_async
+from django.core.exceptions import BadRequest
 from django.http.request import HttpRequest
 from django.views.generic import TemplateView
 
-from .helpers import parse_date
+from .cache import acached_report
+from .helpers import parse_date, parse_int
 from .models import TreasuryRates
-from .reports import get_market_dynamics, get_assets_dynamics
+from .reports import DOWNSAMPLE_MODES, downsample_rates, get_rates_per_day, aget_sectors_report
 
 
 class IndexView(TemplateView):
@@ -12,68 +14,39 @@ class IndexView(TemplateView):
     template_name = 'markets/index.html'
 
 
-class YieldPerDayView(TemplateView):
-    """View class for Yield per Day page"""
-    template_name = 'markets/yield_per_day.html'
+class AsyncTemplateView(TemplateView):
+    """Template view with async GET handler, context is built by `aget_context_data`"""
 
-    def get(self, request, *args, **kwargs):
+    async def get(self, request: HttpRequest, *args, **kwargs):
         kwargs['params'] = request.GET
-        return super().get(request, *args, **kwargs)
+        context = await self.aget_context_data(**kwargs)
+        return self.render_to_response(context)
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        fields = TreasuryRates.get_fields_list()
+    async def aget_context_data(self, **kwargs) -> dict:
+        return self.get_context_data(**kwargs)
+
+
+class YieldPerDayView(AsyncTemplateView):
+    """View class for Yield per Day page"""
+    template_name = 'markets/yield_per_day.html'
 
-        res = list(map(TreasuryRates.serialize_per_day,
-                       TreasuryRates.objects.order_by('-date').values(*fields)))
-        full_res = []
-
-        when = parse_date(kwargs['params'].get('when'))
-        if when:
-            try:
-                custom_res = TreasuryRates.objects.filter(date=when).values(*fields)
-                if custom_res.count():
-                    custom_res = custom_res.first()
-                    custom_res = TreasuryRates.serialize_per_day(custom_res)
-                    custom_res['label'] = custom_res['label'] + ' (Custom)'
-                    full_res.append(custom_res)
-            except ValueError:
-                pass
-
-        selections = {
-            'Yesterday': 0,
-            'Week': 5,
-            'Month': 20,
-            'Quarter': 60,
-            'Half Year': 120,
-            'Year': 250
-        }
-        for period, offset in selections.items():
-            if len(res) < offset:
-                break
-            day_stat = res[offset]
-            label = day_stat['label'] + f' ({period})'
-            day_stat['label'] = label
-            full_res.append(day_stat)
-
-        context['rates'] = {'datasets': full_res}
+    async def aget_context_data(self, **kwargs):
+        context = self.get_context_data(**kwargs)
+        when = [parse_date(day) for day in kwargs['params'].getlist('when')]  # Several dates to compare are allowed
+        context['rates'] = {'datasets': await sync_to_async(get_rates_per_day)(when)}
         return context
 
 
-class YieldPerMaturityView(TemplateView):
+class YieldPerMaturityView(AsyncTemplateView):
     """View class for Yield per Maturity page"""
     template_name = 'markets/yield_per_maturity.html'
 
-    def get(self, request: HttpRequest, *args, **kwargs):
-        kwargs['params'] = request.GET
-        return super().get(request, *args, **kwargs)
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+    async def aget_context_data(self, **kwargs):
+        context = self.get_context_data(**kwargs)
         params = kwargs['params']
         fields = TreasuryRates.get_fields_list()
 
-        query = TreasuryRates.objects.order_by('-date')
+        query = TreasuryRates.objects.order_by('date')
 
         # Filter data for a period
         for filt_str, border_str in [('date__gte', 'since'), ('date__lte', 'to')]:
@@ -84,42 +57,40 @@ class YieldPerMaturityView(TemplateView):
             if border:
                 query = query.filter(**{filt_str: border})
 
-        # Check if query has more than LIMIT of points, then take only Nth elements
-        if 'limit' in params and params['limit']:
-            limit = int(params['limit'])
-        else:
-            limit = 30  # Default LIMIT is 30 points
-        excess = query.count() // limit
-        if excess:
-            offset = query.first().id % excess
-            # query = query.annotate(row_id=Window(expression=RowNumber()))
-            query = query.annotate(idmod=(F('id') - offset) % excess).filter(idmod=0)
-
-        query = query.values(*fields)
-        context['rates'] = TreasuryRates.serialize_per_maturity(sorted(list(query), key=lambda x: x['date']))
+        # Reduce to LIMIT of points, evenly spaced in time or preserving curves shape (default)
+        limit = params.get('limit') or '30'  # Default LIMIT is 30 points
+        if not (limit.isdigit() and int(limit) > 0):
+            raise BadRequest('Limit must be a positive integer')
+        mode = params.get('mode') or 'lttb'
+        if mode not in DOWNSAMPLE_MODES:
+            raise BadRequest(f'Mode must be one of: {", ".join(DOWNSAMPLE_MODES)}')
+
+        rates = downsample_rates([rate async for rate in query.values(*fields)], int(limit), mode)
+        context['rates'] = TreasuryRates.serialize_per_maturity(rates)
         return context
 
 
-class SectorsView(TemplateView):
+class SectorsView(AsyncTemplateView):
     """View class for Market Sectors page"""
     template_name = 'markets/sectors.html'
 
-    def get(self, request: HttpRequest, *args, **kwargs):
-        kwargs['params'] = request.GET
-        return super().get(request, *args, **kwargs)
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+    async def aget_context_data(self, **kwargs):
+        context = self.get_context_data(**kwargs)
         params = kwargs['params']
         custom_since = parse_date(params.get('since'))
         custom_to = None
         if custom_since:
             context['custom'] = True
             custom_to = parse_date(params.get('to'))
+        top = parse_int(params.get('top'), 3, 1, 20)  # Best and worst companies shown per sector
 
-        assets = get_assets_dynamics(custom_since, custom_to)
-        sp500 = assets.pop('S&P 500')
-        context['assets'] = assets
-        context['sp500'] = sp500
-        context['sectors'] = get_market_dynamics(custom_since, custom_to)
+        reports, self.cache_hit = await acached_report(
+            'sectors', {'since': custom_since, 'to': custom_to, 'top': top},
+            lambda: aget_sectors_report(custom_since, custom_to, top))
+        context.update(reports)
         return context
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super().render_to_response(context, **response_kwargs)
+        response['X-Cache'] = 'HIT' if self.cache_hit else 'MISS'
+        return response